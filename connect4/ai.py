@@ -0,0 +1,276 @@
+"""ai.py - Search engine for the Computer player.
+
+Negamax with alpha-beta pruning, center-first move ordering and iterative
+deepening under a time budget. Positions are hashed with Zobrist keys into a
+bounded transposition table. The search only works on an in-memory copy of
+the game's Bitboard, it never touches the datastore."""
+
+import logging
+import random
+import time
+from collections import OrderedDict, namedtuple
+from itertools import islice
+
+from engine import COMPUTER
+
+WIN_SCORE = 1000000
+
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# difficulty: (maximum depth, time budget in seconds)
+DIFFICULTIES = {
+    'EASY': (2, 0.05),
+    'MEDIUM': (5, 0.25),
+    'HARD': (42, 1.5),
+}
+DEFAULT_DIFFICULTY = 'MEDIUM'
+# a search always gets this long, enough to finish depth 1
+MIN_TIME_BUDGET = 0.01
+
+SearchResult = namedtuple('SearchResult',
+                          ['column', 'score', 'depth', 'nodes', 'seconds'])
+
+_zobrist_tables = {}
+_window_tables = {}
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search once the time budget is used up"""
+
+
+class TranspositionTable(object):
+    """Bounded transposition table, the oldest entries are evicted first"""
+
+    def __init__(self, max_size=200000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, depth, flag, score, column):
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+        self.entries[key] = (depth, flag, score, column)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def zobrist_table(bitboard):
+    """Returns the Zobrist keys for every (player, cell) of the board size"""
+    size = (bitboard.rows, bitboard.columns)
+    if size not in _zobrist_tables:
+        rng = random.Random(4242)
+        cells = bitboard.columns * bitboard.column_height
+        _zobrist_tables[size] = [
+            [rng.getrandbits(64) for _ in range(cells)] for _ in range(2)]
+    return _zobrist_tables[size]
+
+
+def zobrist_hash(bitboard):
+    """Computes the Zobrist key of a position from scratch"""
+    table = zobrist_table(bitboard)
+    key = 0
+    for column in range(bitboard.columns):
+        for row in range(bitboard.heights[column]):
+            index = column * bitboard.column_height + row
+            key ^= table[bitboard.cell(column, row)][index]
+    return key
+
+
+def windows(bitboard):
+    """Returns the bit masks of every line of connect cells on the board,
+    ordered by the lowest row they touch, and a list telling for every
+    height how many of the windows lie (partly) below it"""
+    size = (bitboard.rows, bitboard.columns, bitboard.connect)
+    if size not in _window_tables:
+        result = []
+        n = bitboard.connect
+        for column in range(bitboard.columns):
+            for row in range(bitboard.rows):
+                for dc, dr in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    end_column = column + dc * (n - 1)
+                    end_row = row + dr * (n - 1)
+                    if not (0 <= end_column < bitboard.columns and
+                            0 <= end_row < bitboard.rows):
+                        continue
+                    mask = 0
+                    for i in range(n):
+                        mask |= bitboard.cell_mask(column + dc * i,
+                                                   row + dr * i)
+                    result.append((min(row, end_row), mask))
+        result.sort()
+        ends = [sum(1 for low, _ in result if low < height)
+                for height in range(bitboard.rows + 1)]
+        _window_tables[size] = ([mask for _, mask in result], ends)
+    return _window_tables[size]
+
+
+def center_order(columns):
+    """Returns the columns ordered from the center to the edges"""
+    return sorted(range(columns), key=lambda c: (abs(2 * c - columns + 1), c))
+
+
+class Searcher(object):
+    """Runs a single time-bounded search for the player to move"""
+
+    def __init__(self, bitboard, player, max_depth, time_budget,
+                 table=None):
+        self.board = bitboard.copy()
+        self.player = player
+        self.max_depth = max_depth
+        self.deadline = time.time() + time_budget
+        self.table = table if table is not None else TranspositionTable()
+        self.zobrist = zobrist_table(bitboard)
+        self.windows, self.window_ends = windows(bitboard)
+        self.order = center_order(bitboard.columns)
+        self.nodes = 0
+
+    def search(self):
+        """Iterative deepening, returns the SearchResult of the deepest
+        fully searched depth"""
+        start = time.time()
+        moves = [c for c in self.order if self.board.can_play(c)]
+        best = SearchResult(moves[0], 0, 0, 0, 0.0)
+        key = zobrist_hash(self.board)
+        remaining = self.board.rows * self.board.columns - self.board.discs
+        for depth in range(1, min(self.max_depth, remaining) + 1):
+            try:
+                score, column = self._root(key, depth)
+            except SearchTimeout:
+                break
+            best = SearchResult(column, score, depth, self.nodes,
+                                time.time() - start)
+            if abs(score) >= WIN_SCORE - self.board.rows * self.board.columns:
+                break
+        return best._replace(nodes=self.nodes, seconds=time.time() - start)
+
+    def _root(self, key, depth):
+        alpha, beta = -WIN_SCORE - 1, WIN_SCORE + 1
+        best_column = None
+        for column in self._ordered_moves(key):
+            score = -self._child(key, column, self.player, depth, -beta,
+                                 -alpha, 1)
+            if best_column is None or score > alpha:
+                alpha = score
+                best_column = column
+        self.table.put(key, depth, EXACT, alpha, best_column)
+        return alpha, best_column
+
+    def _ordered_moves(self, key):
+        moves = [c for c in self.order if self.board.can_play(c)]
+        entry = self.table.get(key)
+        if entry and entry[3] in moves:
+            moves.remove(entry[3])
+            moves.insert(0, entry[3])
+        return moves
+
+    def _child(self, key, column, player, depth, alpha, beta, ply):
+        """Plays column for player and returns the score of the resulting
+        position from the opponent's point of view"""
+        board = self.board
+        row = board.play(column, player)
+        child_key = key ^ self.zobrist[player][
+            column * board.column_height + row]
+        try:
+            if board.is_win_at(column, row, player):
+                return -(WIN_SCORE - ply)
+            return self._negamax(child_key, 1 - player, depth - 1, alpha,
+                                 beta, ply)
+        finally:
+            board.undo(column, player)
+
+    def _negamax(self, key, player, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & 255 == 0 and time.time() > self.deadline:
+            raise SearchTimeout()
+
+        board = self.board
+        if board.is_full():
+            return 0
+        if depth == 0:
+            return self._evaluate(player)
+
+        original_alpha = alpha
+        entry = self.table.get(key)
+        if entry and entry[0] >= depth:
+            flag, score = entry[1], entry[2]
+            if flag == EXACT:
+                return score
+            if flag == LOWER:
+                alpha = max(alpha, score)
+            elif flag == UPPER:
+                beta = min(beta, score)
+            if alpha >= beta:
+                return score
+
+        best_score = -WIN_SCORE - 1
+        best_column = None
+        for column in self._ordered_moves(key):
+            score = -self._child(key, column, player, depth, -beta, -alpha,
+                                 ply + 1)
+            if score > best_score:
+                best_score = score
+                best_column = column
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.put(key, depth, flag, best_score, best_column)
+        return best_score
+
+    def _evaluate(self, player):
+        """Heuristic score of a quiet position for the player to move:
+        lines only one player occupies are worth more the fuller they are.
+        Windows above the highest disc are empty and skipped, which keeps
+        the evaluation cheap on large boards."""
+        own = self.board.masks[player]
+        other = self.board.masks[1 - player]
+        score = 0
+        end = self.window_ends[max(self.board.heights)]
+        for window in islice(self.windows, end):
+            if own & window:
+                if not other & window:
+                    score += bin(own & window).count('1') ** 2
+            elif other & window:
+                score -= bin(other & window).count('1') ** 2
+        return score
+
+
+def choose_column(bitboard, player=COMPUTER, difficulty=DEFAULT_DIFFICULTY,
+                  time_limit=None):
+    """Returns the column the given player should play next.
+
+    Args:
+        bitboard: The Bitboard of the game, it is not modified.
+        player: The engine player to move (USER or COMPUTER).
+        difficulty: One of the keys of DIFFICULTIES.
+        time_limit: Seconds left until the move is due. Shortens the time
+            budget of the difficulty, the best move of the deepest finished
+            iteration is returned when it runs out.
+    Returns:
+        The SearchResult of the search.
+    """
+    max_depth, time_budget = DIFFICULTIES.get(
+        difficulty, DIFFICULTIES[DEFAULT_DIFFICULTY])
+    if time_limit is not None:
+        time_budget = max(MIN_TIME_BUDGET, min(time_budget, time_limit))
+    result = Searcher(bitboard, player, max_depth, time_budget).search()
+    nps = result.nodes / result.seconds if result.seconds else 0
+    logging.info('AI search: difficulty=%s column=%d score=%d depth=%d '
+                 'nodes=%d time=%.3fs nodes/sec=%d', difficulty,
+                 result.column, result.score, result.depth, result.nodes,
+                 result.seconds, nps)
+    return result
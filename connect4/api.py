@@ -5,21 +5,64 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 import endpoints
+from google.appengine.ext import ndb
 from protorpc import remote, messages
 
-from models import User, Game, Score, Disc, GameHistoryEntry
+from models import User, Game, Score, GameHistoryEntry, UserStats, \
+    user_names, AI_USER_NAME, OPEN
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm, \
-    ScoreForms, RankingForms, RankingForm, GameForms, GameHistoryForms
-from utils import get_by_urlsafe
+    ScoreForms, RankingForms, GameForms, GameHistoryForms, \
+    CacheStatsForm, CacheStatsForms, MakeMovesForm, MoveResultForm, \
+    MoveResultForms, ReplayForm, RankingForm
+from computer import cache_stats
+from formcache import get_game_form, get_game_form_async, \
+    set_game_forms_async, forget_game_forms_async, not_modified
+from instrumentation import install, instrumented, increment
+import leaderboard
+from notify import get_channel, game_topic, publish_game
+from ratelimit import check_rate, check_rates
+from turns import play_user_move_async, play_moves_async, \
+    cancel_game_async, batch_game_keys, MOVE_OK
+from utils import get_by_urlsafe_async, get_key_by_urlsafe, \
+    get_page_args, get_offset_args, next_cursor
+from workers import get_pool
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
-GET_GAME_REQUEST = endpoints.ResourceContainer(
+GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1), )
+GET_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    etag=messages.StringField(2), )
+POLL_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    etag=messages.StringField(2, required=True),
+    timeout=messages.IntegerField(3), )
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1), )
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1),
+    cursor=messages.StringField(2), )
+USER_NAME_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1), )
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    cursor=messages.StringField(3), )
+GAME_PAGE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    cursor=messages.StringField(3), )
+REPLAY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    ply=messages.IntegerField(2), )
+
+DEFAULT_POLL_SECONDS = 20
+MAX_POLL_SECONDS = 50
+
+install()
 
 
 @endpoints.api(name='connect_4', version='v1')
@@ -31,6 +74,7 @@ class Connect4Api(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented('create_user')
     def create_user(self, request):
         """Creates a User.
 
@@ -44,11 +88,21 @@ class Connect4Api(remote.Service):
             endpoints.ConflictException: If the user already exists.
         """
 
-        if User.query(User.name == request.user_name).get():
+        if User.get_key_by_name(request.user_name):
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+
+        def create():
+            key = ndb.Key(User, request.user_name)
+            if key.get():
+                raise endpoints.ConflictException(
+                    'A User with that name already exists!')
+            user = User(key=key, name=request.user_name, email=request.email)
+            stats = UserStats(key=UserStats.key_for(key), user=key,
+                              user_name=user.name)
+            ndb.put_multi([user, stats])
+
+        ndb.transaction(create)
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -57,235 +111,383 @@ class Connect4Api(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented('new_game')
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user_key = User.get_key_by_name(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
 
-        game = Game.new_game(user.key)
+        try:
+            game = Game.new_game(user_key, request.difficulty.name,
+                                 request.rows, request.columns,
+                                 request.connect)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
 
-        return game.to_form('Good luck playing Connect4!')
+        form = game.to_form('Good luck playing Connect4!', request.user_name)
+        set_game_forms_async([form]).get_result()
+        return form
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented('get_game')
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return game.to_form('Game found!')
-        else:
+        """Return the current game state. The form is read through memcache.
+        If the client sends the etag of the current state (as parameter or
+        If-None-Match header) only a short 'not modified' form is returned.
+        Concurrent reads of a game share one read."""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        check_rate('get_game', game_key, self._client())
+        form = get_game_form(game_key)
+        if not form:
             raise endpoints.NotFoundException('Game not found!')
-
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+        etag = request.etag or self._if_none_match()
+        if etag and etag.strip('"') == form.etag:
+            increment('get_game.not_modified')
+            return not_modified(form)
+        return form
+
+    def _if_none_match(self):
+        state = getattr(self, 'request_state', None)
+        headers = getattr(state, 'headers', None)
+        return headers.get('If-None-Match') if headers else None
+
+    def _client(self):
+        """Returns the remote address the rate limits of the caller are
+        kept under"""
+        state = getattr(self, 'request_state', None)
+        return getattr(state, 'remote_address', None) or 'unknown'
+
+    @endpoints.method(request_message=POLL_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/poll',
+                      name='poll_game',
+                      http_method='GET')
+    @instrumented('poll_game')
+    @ndb.synctasklet
+    def poll_game(self, request):
+        """Long poll: waits up to timeout seconds for a newer state of the
+        game than the one of etag and returns its GameForm. Returns a
+        'not modified' form if nothing changed in time."""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        try:
+            version = int(request.etag.strip('"'))
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid etag')
+        timeout = min(request.timeout or DEFAULT_POLL_SECONDS,
+                      MAX_POLL_SECONDS)
+        check_rate('get_game', game_key, self._client())
+
+        form = get_game_form(game_key)
+        if not form:
+            raise endpoints.NotFoundException('Game not found!')
+        if int(form.etag) > version:
+            raise ndb.Return(form)
+        if form.game_over or form.game_canceled:
+            # the game will not change anymore
+            raise ndb.Return(not_modified(form))
+
+        if get_channel().wait(game_topic(game_key), version,
+                              timeout) is None:
+            increment('poll_game.timeouts')
+            raise ndb.Return(not_modified(form))
+        increment('poll_game.notified')
+        # all pollers of the game wake up at once and share the read
+        form = get_game_form(game_key)
+        if int(form.etag) <= version:
+            # the shared read started before the change was committed
+            form = yield get_game_form_async(game_key)
+        raise ndb.Return(form)
+
+    @endpoints.method(request_message=GAME_PAGE_REQUEST,
                       response_message=GameHistoryForms,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented('get_game_history')
+    @ndb.synctasklet
     def get_game_history(self, request):
-        """Return the history for the given game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            history_entry = GameHistoryEntry.query(GameHistoryEntry.game == game.key).order(GameHistoryEntry.created_at)
-            return GameHistoryForms(items=[entry.to_form() for entry in history_entry])
-        else:
+        """Return one page of the history for the given game. The history is
+        decoded from the move log of the game, so this is a single get. The
+        cursor is the number of moves to skip."""
+        limit, offset = get_offset_args(request)
+        game = yield get_by_urlsafe_async(request.urlsafe_game_key, Game)
+        if not game:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+        if game.move_log is not None:
+            forms = game.history_forms()
+        else:
+            # game started before the move log, not yet migrated
+            entries = yield GameHistoryEntry.query(
+                GameHistoryEntry.game == game.key).fetch_async()
+            forms = [entry.to_form() for entry in
+                     sorted(entries, key=lambda e: e.created_at)]
+        end = offset + limit
+        raise ndb.Return(GameHistoryForms(
+            items=forms[offset:end],
+            next_cursor=str(end) if end < len(forms) else None))
+
+    @endpoints.method(request_message=REPLAY_REQUEST,
+                      response_message=ReplayForm,
+                      path='game/{urlsafe_game_key}/replay',
+                      name='get_game_replay',
+                      http_method='GET')
+    @instrumented('get_game_replay')
+    @ndb.synctasklet
+    def get_game_replay(self, request):
+        """Returns the board of the game after the given number of
+        half-moves, replayed from the move log. Without ply the final
+        board is returned."""
+        game = yield get_by_urlsafe_async(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.move_log is None:
+            raise endpoints.BadRequestException(
+                'The game has no move log yet, it has to be migrated first')
+
+        plies = len(game.move_log)
+        ply = plies if request.ply is None else request.ply
+        if not 0 <= ply <= plies:
+            raise endpoints.BadRequestException(
+                'Ply must be between 0 and {}'.format(plies))
+        history = game.history_forms()
+        raise ndb.Return(ReplayForm(
+            urlsafe_key=game.key.urlsafe(),
+            ply=ply,
+            plies=plies,
+            board=game.render_board(game.replay(ply)),
+            result=history[ply - 1].result if ply else None))
+
+    @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented('cancel_game')
+    @ndb.synctasklet
     def cancel_game(self, request):
         """Cancels the running game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            # TODO: implement cancel method
-            if game.game_over:
-                raise endpoints.BadRequestException('Game already over!')
-            if game.game_canceled:
-                raise endpoints.BadRequestException('Game already canceled!')
-
-            game.game_canceled = True
-            game.put()
-
-            return game.to_form('Game canceled!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
-
-    @endpoints.method(request_message=USER_REQUEST,
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield cancel_game_async(game_key)
+        form = yield game.to_form_async('Game canceled!')
+        yield set_game_forms_async([form])
+        publish_game(game)
+        raise ndb.Return(form)
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented('get_user_games')
     def get_user_games(self, request):
-        """Returns all of an individual User's games"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns one page of an individual User's open games, the most
+        recently played first"""
+        user_key = User.get_key_by_name(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key)
-        games = games.filter(Game.game_canceled == False)
-        games = games.filter(Game.game_over == False)
-        return GameForms(items=[game.to_form('') for game in games])
+        limit, cursor = get_page_args(request)
+        games = Game.query(Game.user == user_key, Game.status == OPEN)
+        games = games.order(-Game.last_activity)
+        games, cursor, more = games.fetch_page(limit, start_cursor=cursor)
+        return GameForms(items=[game.to_form('', request.user_name) for game in games],
+                         next_cursor=next_cursor(cursor, more))
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented('make_move')
+    @ndb.synctasklet
     def make_move(self, request):
-        """Makes a move. Returns a game state with message"""
-
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-
-        if game.game_over:
-            return game.to_form('Game already over!')
-
-        if game.game_canceled:
-            return game.to_form('Game has been canceled!')
-
-        if request.move_column < 0 or request.move_column >= game.columns:
-            raise endpoints.BadRequestException('Column must be within game Boundaries')
-
-        game_discs = Disc.query(ancestor=game.key)
-        game_discs = game_discs.filter(Disc.column == request.move_column)
-        rows_filled = game_discs.count()
-
-        if rows_filled >= game.rows:
-            raise endpoints.BadRequestException('Column is filled')
-
-        # do user move
-        game.moves += 1
-
-        disc = Disc(parent=game.key, user=game.user, column=request.move_column, row=rows_filled)
-        disc.put()
-
-        if game.check_win(user=game.user):
-            # end game
-            game.end_game(True)
-
-            # store history entry
-            game.store_history_entry(column=request.move_column, row=rows_filled, result="won")
-            # store game state
-            game.store_game_state()
-
-            return game.to_form('You win!')
-
-        if game.check_full():
-            game.end_game(False)
-
-            # store history entry
-            game.store_history_entry(column=request.move_column, row=rows_filled, result="game ended with no winner")
-            # store game state
-            game.store_game_state()
-
-            return game.to_form('Game over! No one wins! Player was last!')
-        else:
-            # store history entry
-            game.store_history_entry(column=request.move_column, row=rows_filled, result="player made move")
-            # store game state
-            game.store_game_state()
-
-        # do AI move ...
-        ai_user = User.query(User.name == 'Computer').get()
-        if not ai_user:
-            raise endpoints.NotFoundException(
-                'No AI User!')
-
-        move_column = game.get_free_column()
-        game_discs = Disc.query(ancestor=game.key)
-        game_discs = game_discs.filter(Disc.column == move_column)
-        ai_rows_filled = game_discs.count()
-
-        disc = Disc(parent=game.key, user=ai_user.key, column=move_column, row=ai_rows_filled)
-        disc.put()
-
-        # check_win() --> check AI win
-        if game.check_win(user=ai_user.key):
-            game.end_game(False)
-
-            # store history entry
-            game.store_history_entry(column=move_column, row=ai_rows_filled, result="game lost")
-            # store game state
-            game.store_game_state()
-
-            return game.to_form('Game Over! You lost!')
-
-        if game.check_full():
-            game.end_game(False)
-
-            # store history entry
-            game.store_history_entry(column=move_column, row=ai_rows_filled, result="game ended with no winner")
-            # store game state
-            game.store_game_state()
-
-            return game.to_form('Game over! No one wins! Computer was last!')
-        else:
-            game.put()
-
-            # store history entry
-            game.store_history_entry(column=move_column, row=ai_rows_filled, result="Computer made move")
-            # store game state
-            game.store_game_state()
-
-        return game.to_form('Nice try! Go on!')
-
-    @endpoints.method(response_message=RankingForms,
+        """Makes a move. Returns a game state with message, the reply of
+        the Computer follows asynchronously (ai_pending is set until then)"""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        check_rate('make_move', game_key, self._client())
+
+        game, message = yield play_user_move_async(
+            game_key, request.move_column, get_pool())
+        form = yield game.to_form_async(message)
+        # the pool may already have stored the form with the reply, so the
+        # cached form is dropped instead of replaced
+        yield forget_game_forms_async([game_key])
+        publish_game(game)
+        raise ndb.Return(form)
+
+    @endpoints.method(request_message=MakeMovesForm,
+                      response_message=MoveResultForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented('make_moves')
+    @ndb.synctasklet
+    def make_moves(self, request):
+        """Makes several moves, in one or more games, at once. Moves of the
+        same game are played in order. Returns the status of every move."""
+        keys = []
+        for move in request.moves:
+            try:
+                keys.append(get_key_by_urlsafe(move.urlsafe_game_key, Game))
+            except (endpoints.BadRequestException, ValueError):
+                keys.append(None)
+        moves = [(key, move.move_column)
+                 for key, move in zip(keys, request.moves) if key]
+        # too large batches are rejected before they take any token, a
+        # batch counts as one make_move on every game it touches
+        check_rates('make_move', batch_game_keys(moves), self._client())
+
+        ai_user_key = User.get_ai_key_async()
+        results, games = yield play_moves_async(moves, ai_user_key)
+
+        # the form of every game shows its state after the whole batch
+        messages_by_game = {}
+        results = iter(results)
+        statuses = []
+        for key in keys:
+            status, message = next(results) if key else \
+                ('INVALID_KEY', 'Invalid Key')
+            statuses.append((status, message))
+            if status == MOVE_OK:
+                messages_by_game[key] = message
+            elif key and games.get(key):
+                messages_by_game.setdefault(key, message)
+        names = user_names([games[key].user for key in messages_by_game])
+        forms = dict((key, games[key].to_form(message,
+                                              names.get(games[key].user)))
+                     for key, message in messages_by_game.items())
+        yield set_game_forms_async(forms.values())
+        for key in forms:
+            publish_game(games[key])
+
+        raise ndb.Return(MoveResultForms(items=[
+            MoveResultForm(urlsafe_game_key=move.urlsafe_game_key,
+                           status=status, message=message,
+                           game=forms.get(key))
+            for move, key, (status, message)
+            in zip(request.moves, keys, statuses)]))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=RankingForms,
                       path='rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented('get_user_rankings')
     def get_user_rankings(self, request):
-        """Gets user rankings"""
-        items = []
-
-        # get all users
-        query = User.query(User.name != 'Computer')
-
-        for user in query:
-            # get score count
-            score_query = Score.query(Score.user == user.key)
-            score_count = score_query.count()
-
-            # get win count
-            win_query = score_query.filter(Score.won == True)
-            win_count = win_query.count()
-            if win_count == 0:
-                ratio = float(0)
-            else:
-                ratio = float(win_count) / float(score_count)
-            items.append([user.name, ratio])
-
-        # sort tuples by ratio
-        items.sort(key=lambda tup: tup[1], reverse=True)
-
-        return RankingForms(items=[RankingForm(user_name=item[0], win_ration=item[1]) for item in items])
+        """Gets user rankings ordered by win ratio, one page at a time"""
+        limit, cursor = get_page_args(request)
+        query = UserStats.query().order(-UserStats.win_ratio,
+                                        -UserStats.games)
+        # the Computer has no UserStats of its own, but stats left by an
+        # older backfill are skipped without making the page shorter
+        results = query.iter(start_cursor=cursor, produce_cursors=True)
+        stats = []
+        for user_stats in results:
+            if user_stats.user_name != AI_USER_NAME:
+                stats.append(user_stats)
+                if len(stats) == limit:
+                    break
+        more = len(stats) == limit and results.probably_has_next()
+        cursor = results.cursor_after() if stats else None
+
+        return RankingForms(items=[s.to_form() for s in stats],
+                            next_cursor=next_cursor(cursor, more))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=RankingForms,
+                      path='leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @instrumented('get_leaderboard')
+    def get_leaderboard(self, request):
+        """Returns one page of the leaderboard snapshot, the top users first.
+        The cursor is the number of ranks to skip."""
+        limit, offset = get_offset_args(request)
+        snapshot, rows = leaderboard.page(offset, limit)
+        if not snapshot:
+            return RankingForms(items=[], total=0)
+        end = offset + len(rows)
+        return RankingForms(
+            items=[RankingForm(rank=row.rank, user_name=row.user_name,
+                               win_ration=float(row.wins) / row.games,
+                               games=row.games, wins=row.wins,
+                               losses=row.losses, draws=row.draws)
+                   for row in rows],
+            next_cursor=str(end) if end < snapshot.total else None,
+            total=snapshot.total, built=snapshot.built)
+
+    @endpoints.method(request_message=USER_NAME_REQUEST,
+                      response_message=RankingForm,
+                      path='leaderboard/user/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented('get_user_rank')
+    def get_user_rank(self, request):
+        """Returns the results of a user with their rank in the leaderboard
+        snapshot. The rank is not set below the minimum number of games."""
+        user_key = User.get_key_by_name(request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        stats = UserStats.get_or_create(user_key, request.user_name)
+        form = stats.to_form()
+        if request.user_name != AI_USER_NAME:
+            form.rank = leaderboard.rank_of(stats.wins, stats.games)
+        return form
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented('get_scores')
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return one page of all scores"""
+        limit, cursor = get_page_args(request)
+        scores, cursor, more = Score.query().fetch_page(limit,
+                                                        start_cursor=cursor)
+        names = user_names([score.user for score in scores])
+        return ScoreForms(items=[score.to_form(names.get(score.user))
+                                 for score in scores],
+                          next_cursor=next_cursor(cursor, more))
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented('get_user_scores')
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns one page of an individual User's scores"""
+        user_key = User.get_key_by_name(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        limit, cursor = get_page_args(request)
+        scores = Score.query(Score.user == user_key)
+        scores, cursor, more = scores.fetch_page(limit, start_cursor=cursor)
+        return ScoreForms(items=[score.to_form(request.user_name) for score in scores],
+                          next_cursor=next_cursor(cursor, more))
+
+    @endpoints.method(response_message=CacheStatsForms,
+                      path='ai/stats',
+                      name='get_ai_stats',
+                      http_method='GET')
+    @instrumented('get_ai_stats')
+    def get_ai_stats(self, request):
+        """Returns the hit/miss counters of the opening book and the
+        position caches of this instance"""
+        return CacheStatsForms(items=[
+            CacheStatsForm(name=name, hits=stats['hits'],
+                           misses=stats['misses'], size=stats.get('size'))
+            for name, stats in sorted(cache_stats().items())])
 
 
 api = endpoints.api_server([Connect4Api])
@@ -0,0 +1,137 @@
+"""batch.py - Win and full board detection for many boards at once.
+
+check_grids() takes N boards as cell grids (N x rows x columns, row 0 is the
+bottom row, cells are USER, COMPUTER or EMPTY), check_bitboards() takes
+Bitboard objects or the byte strings of Bitboard.pack(). Both return, per
+board, whether USER and COMPUTER connected a line and whether the board is
+full, with the same rules as Bitboard.is_win() and Bitboard.is_full().
+
+With NumPy installed the boards are evaluated as arrays in one pass per
+direction. Without it every board is laid out in one long Python integer,
+separated by connect - 1 empty columns so no line can run from one board into
+the next, and the shift and AND scan of Bitboard.is_win() runs once over all
+of them."""
+
+from engine import Bitboard, USER, COMPUTER
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EMPTY = -1
+PLAYERS = (USER, COMPUTER)
+
+
+def check_grids(boards, rows, columns, connect=4):
+    """Returns (wins, full) for N boards of cells. wins[i][player] is True if
+    player has a line on board i, full[i] is True if no cell is EMPTY."""
+    if not len(boards):
+        return [], []
+    if numpy is not None:
+        return _check_grid_arrays(numpy.asarray(boards), connect)
+    bitboards = [_grid_to_bitboard(board, rows, columns, connect)
+                 for board in boards]
+    return check_bitboards(bitboards)
+
+
+def check_bitboards(bitboards):
+    """Returns (wins, full) like check_grids() for Bitboards or packed
+    positions, which all need to have the same size"""
+    bitboards = [Bitboard.unpack(board) if isinstance(board, str) else board
+                 for board in bitboards]
+    if not bitboards:
+        return [], []
+    first = bitboards[0]
+    for board in bitboards:
+        if (board.rows, board.columns, board.connect) != \
+                (first.rows, first.columns, first.connect):
+            raise ValueError('All boards need to have the same size')
+    if numpy is not None and first.columns * first.column_height <= 64:
+        return _check_mask_arrays(bitboards)
+    return _check_concatenated(bitboards)
+
+
+def _grid_to_bitboard(board, rows, columns, connect):
+    bitboard = Bitboard(rows, columns, connect)
+    for column in range(columns):
+        for row in range(rows):
+            cell = board[row][column]
+            if cell != EMPTY:
+                bitboard.masks[cell] |= bitboard.cell_mask(column, row)
+                bitboard.heights[column] = row + 1
+                bitboard.discs += 1
+    return bitboard
+
+
+def _check_grid_arrays(boards, connect):
+    n, rows, columns = boards.shape
+    wins = numpy.zeros((n, 2), dtype=bool)
+    # (row step, column step): vertical, horizontal, / diagonal, \ diagonal
+    for dr, dc in ((1, 0), (0, 1), (1, 1), (-1, 1)):
+        row_span = abs(dr) * (connect - 1)
+        column_span = dc * (connect - 1)
+        if row_span >= rows or column_span >= columns:
+            continue
+        height = rows - row_span
+        width = columns - column_span
+        for player in PLAYERS:
+            owned = boards == player
+            start = row_span if dr < 0 else 0
+            line = numpy.ones((n, height, width), dtype=bool)
+            for i in range(connect):
+                r = start + dr * i
+                c = dc * i
+                line &= owned[:, r:r + height, c:c + width]
+            wins[:, player] |= line.reshape(n, -1).any(axis=1)
+    full = (boards != EMPTY).reshape(n, -1).all(axis=1)
+    return wins.tolist(), full.tolist()
+
+
+def _check_mask_arrays(bitboards):
+    first = bitboards[0]
+    h = first.column_height
+    full_count = first.rows * first.columns
+    wins = []
+    for player in PLAYERS:
+        masks = numpy.array([board.masks[player] for board in bitboards],
+                            dtype=numpy.uint64)
+        won = numpy.zeros(len(bitboards), dtype=bool)
+        for shift in (1, h, h + 1, h - 1):
+            m = masks.copy()
+            for i in range(1, first.connect):
+                if shift * i >= 64:
+                    # NumPy does not define shifts by the full width
+                    m[:] = 0
+                    break
+                m &= masks >> numpy.uint64(shift * i)
+            won |= m != 0
+        wins.append(won)
+    full = numpy.array([board.discs >= full_count for board in bitboards])
+    return numpy.column_stack(wins).tolist(), full.tolist()
+
+
+def _check_concatenated(bitboards):
+    first = bitboards[0]
+    h = first.column_height
+    stride = (first.columns + first.connect - 1) * h
+    board_mask = (1 << (first.columns * h)) - 1
+    full_count = first.rows * first.columns
+    found = []
+    for player in PLAYERS:
+        bb = 0
+        for i, board in enumerate(bitboards):
+            bb |= board.masks[player] << (i * stride)
+        lines = 0
+        for shift in (1, h, h + 1, h - 1):
+            m = bb
+            for i in range(1, first.connect):
+                m &= bb >> (shift * i)
+                if not m:
+                    break
+            lines |= m
+        found.append(lines)
+    wins = [[bool((lines >> (i * stride)) & board_mask) for lines in found]
+            for i in range(len(bitboards))]
+    full = [board.discs >= full_count for board in bitboards]
+    return wins, full
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Offline benchmark of the Connect4Api endpoints.
+
+Runs the API methods against the local datastore stub of the App Engine SDK
+testbed. Plays scripted and randomized full games, records latency
+percentiles, datastore RPC counts and entity reads/writes per endpoint call
+and runs microbenchmarks of the game logic. The results are printed (or
+written) as JSON so runs before and after a change can be compared.
+
+    python benchmark.py --games 20 --difficulty EASY --output bench.json
+
+The App Engine SDK has to be on the PYTHONPATH."""
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+SCRIPTED_COLUMNS = [3, 3, 2, 4, 1, 5, 0, 6, 2, 4, 3, 1, 5, 0, 6]
+
+
+class RpcCounter(object):
+    """Counts datastore RPCs and the entities they read and write"""
+
+    def __init__(self):
+        self.reset()
+
+    def install(self):
+        hooks = apiproxy_stub_map.apiproxy
+        hooks.GetPreCallHooks().Append('benchmark', self._pre_call,
+                                       'datastore_v3')
+        hooks.GetPostCallHooks().Append('benchmark', self._post_call,
+                                        'datastore_v3')
+
+    def reset(self):
+        self.calls = defaultdict(int)
+        self.entities_read = 0
+        self.entities_written = 0
+
+    def _pre_call(self, service, call, request, response):
+        self.calls[call] += 1
+        if call == 'Get':
+            self.entities_read += request.key_size()
+        elif call == 'Put':
+            self.entities_written += request.entity_size()
+        elif call == 'Delete':
+            self.entities_written += request.key_size()
+
+    def _post_call(self, service, call, request, response, *args):
+        if call in ('RunQuery', 'Next') and hasattr(response, 'result_size'):
+            self.entities_read += response.result_size()
+
+    def snapshot(self):
+        return dict(self.calls), self.entities_read, self.entities_written
+
+
+class Recorder(object):
+    """Collects latency and RPC samples per endpoint"""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.samples = defaultdict(list)
+
+    def call(self, name, method, request):
+        ndb.get_context().clear_cache()
+        self.counter.reset()
+        start = time.time()
+        response = method(request)
+        ndb.get_context().flush().get_result()
+        elapsed = time.time() - start
+        self.samples[name].append((elapsed,) + self.counter.snapshot())
+        return response
+
+    def report(self):
+        result = {}
+        for name, samples in sorted(self.samples.items()):
+            latencies = sorted(s[0] * 1000.0 for s in samples)
+            rpcs = defaultdict(int)
+            for sample in samples:
+                for call, count in sample[1].items():
+                    rpcs[call] += count
+            count = len(samples)
+            result[name] = {
+                'calls': count,
+                'latency_ms': {
+                    'mean': sum(latencies) / count,
+                    'p50': percentile(latencies, 50),
+                    'p90': percentile(latencies, 90),
+                    'p99': percentile(latencies, 99),
+                    'max': latencies[-1],
+                },
+                'rpcs_per_call': dict((call, float(total) / count)
+                                      for call, total in rpcs.items()),
+                'total_rpcs_per_call':
+                    float(sum(rpcs.values())) / count,
+                'entities_read_per_call':
+                    float(sum(s[2] for s in samples)) / count,
+                'entities_written_per_call':
+                    float(sum(s[3] for s in samples)) / count,
+            }
+        return result
+
+
+def percentile(sorted_values, p):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def setup_testbed():
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    bed.init_taskqueue_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+def free_columns(form):
+    """Columns of the rendered board in a GameForm that can take a disc"""
+    return [i for i, column in enumerate(form.board) if '_' in column]
+
+
+def play_game(api, recorder, user_name, difficulty, rng, scripted):
+    """Plays one full game through the API, returns the urlsafe key of the
+    game and the number of user moves"""
+    from api import NEW_GAME_REQUEST, MAKE_MOVE_REQUEST, GET_GAME_REQUEST
+    from models import Difficulty
+
+    form = recorder.call('new_game', api.new_game,
+                         NEW_GAME_REQUEST.combined_message_class(
+                             user_name=user_name,
+                             difficulty=Difficulty(difficulty)))
+    key = form.urlsafe_key
+    moves = 0
+    while not form.game_over:
+        columns = free_columns(form)
+        if scripted and moves < len(SCRIPTED_COLUMNS) and \
+                SCRIPTED_COLUMNS[moves] in columns:
+            column = SCRIPTED_COLUMNS[moves]
+        else:
+            column = rng.choice(columns)
+        form = recorder.call('make_move', api.make_move,
+                             MAKE_MOVE_REQUEST.combined_message_class(
+                                 urlsafe_game_key=key, move_column=column))
+        moves += 1
+        # the reply of the Computer is computed inline by the ThreadPool
+        # without workers, get_game returns the board with it
+        form = recorder.call('get_game', api.get_game,
+                             GET_GAME_REQUEST.combined_message_class(
+                                 urlsafe_game_key=key))
+        recorder.call('get_game_not_modified', api.get_game,
+                      GET_GAME_REQUEST.combined_message_class(
+                          urlsafe_game_key=key, etag=form.etag))
+    return key, moves
+
+
+def run_endpoints(games, difficulty, seed):
+    import leaderboard
+    from api import Connect4Api, USER_REQUEST, PAGE_REQUEST, \
+        USER_PAGE_REQUEST, USER_NAME_REQUEST, GAME_PAGE_REQUEST, \
+        REPLAY_REQUEST
+    from ratelimit import Limiter, set_limiter
+    from workers import ThreadPool, set_pool
+
+    class Unlimited(Limiter):
+        def take(self, buckets):
+            return None
+
+    # replies are computed in the make_move call, so they are measured
+    set_pool(ThreadPool(workers=0))
+    # the benchmark plays as fast as it can from a single client
+    set_limiter(Unlimited())
+    counter = RpcCounter()
+    counter.install()
+    recorder = Recorder(counter)
+    api = Connect4Api()
+    rng = random.Random(seed)
+
+    for name in ('Computer', 'bench-scripted', 'bench-random'):
+        recorder.call('create_user', api.create_user,
+                      USER_REQUEST.combined_message_class(user_name=name))
+
+    total_moves = 0
+    start = time.time()
+    for i in range(games):
+        scripted = i % 2 == 0
+        user_name = 'bench-scripted' if scripted else 'bench-random'
+        key, moves = play_game(api, recorder, user_name, difficulty, rng,
+                               scripted)
+        total_moves += moves
+        recorder.call('get_game_history', api.get_game_history,
+                      GAME_PAGE_REQUEST.combined_message_class(
+                          urlsafe_game_key=key))
+        recorder.call('get_game_replay', api.get_game_replay,
+                      REPLAY_REQUEST.combined_message_class(
+                          urlsafe_game_key=key, ply=moves))
+    elapsed = time.time() - start
+
+    for user_name in ('bench-scripted', 'bench-random'):
+        request = USER_PAGE_REQUEST.combined_message_class(
+            user_name=user_name)
+        recorder.call('get_user_games', api.get_user_games, request)
+        recorder.call('get_user_scores', api.get_user_scores, request)
+    recorder.call('get_scores', api.get_scores,
+                  PAGE_REQUEST.combined_message_class())
+    recorder.call('get_user_rankings', api.get_user_rankings,
+                  PAGE_REQUEST.combined_message_class())
+    recorder.call('build_leaderboard',
+                  lambda _: leaderboard.build_snapshot(), None)
+    recorder.call('get_leaderboard', api.get_leaderboard,
+                  PAGE_REQUEST.combined_message_class())
+    for user_name in ('bench-scripted', 'bench-random'):
+        recorder.call('get_user_rank', api.get_user_rank,
+                      USER_NAME_REQUEST.combined_message_class(
+                          user_name=user_name))
+
+    report = recorder.report()
+    return {
+        'games': games,
+        'moves': total_moves,
+        'seconds': elapsed,
+        'moves_per_second': total_moves / elapsed if elapsed else None,
+        'endpoints': report,
+    }
+
+
+def microbenchmark(function, repeat):
+    """Returns the mean time of function in microseconds"""
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - start) / repeat * 1e6
+
+
+def run_micro(repeat, difficulty, seed):
+    import ai
+    import batch
+    from engine import Bitboard, USER, COMPUTER
+    from models import Game
+
+    rng = random.Random(seed)
+    # an empty position, so get_bitboard does not query the Discs of a
+    # game without key
+    game = Game(user=ndb.Key('User', 'bench'), rows=6, columns=7,
+                difficulty=difficulty, position=Bitboard(6, 7, 4).pack())
+    bitboard = game.get_bitboard()
+    player = USER
+    # a random mid game position
+    for _ in range(16):
+        column = rng.choice(bitboard.free_columns())
+        bitboard.play(column, player)
+        if bitboard.is_win(player):
+            bitboard.undo(column, player)
+        player = COMPUTER if player == USER else USER
+    game.position = bitboard.pack()
+
+    return {
+        'check_win_us': microbenchmark(
+            lambda: game.check_win(game.user), repeat),
+        'check_full_us': microbenchmark(game.check_full, repeat),
+        'render_board_us': microbenchmark(game.render_board, repeat),
+        'pack_unpack_us': microbenchmark(
+            lambda: bitboard.unpack(bitboard.pack()), repeat),
+        'ai_search_us': microbenchmark(
+            lambda: ai.choose_column(bitboard, COMPUTER, difficulty),
+            max(1, repeat // 1000)),
+        'get_ai_column_cached_us': microbenchmark(game.get_ai_column,
+                                                  repeat),
+        'batch_check_1000_boards_us': microbenchmark(
+            lambda: batch.check_bitboards([bitboard] * 1000),
+            max(1, repeat // 1000)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--difficulty', default='EASY',
+                        choices=['EASY', 'MEDIUM', 'HARD'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10000,
+                        help='iterations of each microbenchmark')
+    parser.add_argument('--output', help='JSON file, default is stdout')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bed = setup_testbed()
+    try:
+        result = {
+            'config': vars(args),
+            'api': run_endpoints(args.games, args.difficulty, args.seed),
+            'micro': run_micro(args.repeat, args.difficulty, args.seed),
+        }
+    finally:
+        bed.deactivate()
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
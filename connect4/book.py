@@ -0,0 +1,94 @@
+"""book.py - Precomputed opening book for the Computer player.
+
+The book is a binary file with a small header followed by records sorted by
+the canonical position key (see Bitboard.canonical_key). Each record is an
+8 byte key and the 1 byte column to play in the canonical orientation. The
+file is memory-mapped once per instance and searched with a binary search.
+The book can be rebuilt with build_book.py."""
+
+import logging
+import os
+import struct
+
+HEADER = struct.Struct('>4sBBBBI')
+RECORD = struct.Struct('>QB')
+MAGIC = b'C4BK'
+VERSION = 1
+
+BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'book.bin')
+
+
+class OpeningBook(object):
+    """Read-only view on a book file"""
+
+    def __init__(self, data, rows, columns, connect, count):
+        self.data = data
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.count = count
+
+    @classmethod
+    def load(cls, path=BOOK_PATH):
+        """Maps the book file into memory, falls back to reading it if mmap
+        is not available. Returns None if there is no usable book."""
+        try:
+            with open(path, 'rb') as f:
+                try:
+                    import mmap
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ImportError, EnvironmentError, ValueError):
+                    data = f.read()
+        except EnvironmentError:
+            logging.warning('No opening book found at %s', path)
+            return None
+
+        magic, version, rows, columns, connect, count = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            logging.warning('Invalid opening book %s', path)
+            return None
+        return cls(data, rows, columns, connect, count)
+
+    def supports(self, bitboard):
+        return (bitboard.rows, bitboard.columns, bitboard.connect) == \
+            (self.rows, self.columns, self.connect)
+
+    def lookup(self, bitboard):
+        """Returns the book column for the position or None"""
+        if not self.supports(bitboard):
+            return None
+        key, mirrored = bitboard.canonical_key()
+        column = self._find(key)
+        if column is None:
+            return None
+        if mirrored:
+            column = bitboard.columns - 1 - column
+        return column
+
+    def _find(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record_key, column = RECORD.unpack_from(
+                self.data, HEADER.size + middle * RECORD.size)
+            if record_key < key:
+                low = middle + 1
+            elif record_key > key:
+                high = middle
+            else:
+                return column
+        return None
+
+
+def write_book(path, rows, columns, connect, entries):
+    """Writes a book file from a dict of canonical key -> column"""
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, rows, columns, connect,
+                            len(entries)))
+        for key in sorted(entries):
+            f.write(RECORD.pack(key, entries[key]))
+
+
+OPENING_BOOK = OpeningBook.load()
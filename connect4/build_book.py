@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""build_book.py - Builds the opening book file used by book.py.
+
+Starting from the empty board every user reply is expanded, the Computer
+always answers with the book move, so the book covers every position the
+Computer can face in the first plies. Positions are stored by canonical key,
+mirror images share one record.
+
+    python build_book.py --plies 7 --depth 8 book.bin
+"""
+
+import argparse
+import logging
+
+from ai import Searcher
+from book import write_book
+from engine import Bitboard, USER, COMPUTER
+
+
+def build(rows, columns, connect, plies, depth):
+    entries = {}
+    frontier = {Bitboard(rows, columns, connect).canonical_key()[0]:
+                Bitboard(rows, columns, connect)}
+    while frontier:
+        next_frontier = {}
+        for board in frontier.values():
+            for column in board.free_columns():
+                child = board.copy()
+                child.play(column, USER)
+                if child.is_win(USER) or child.is_full() or \
+                        child.discs > plies:
+                    continue
+                key, mirrored = child.canonical_key()
+                if key in entries:
+                    continue
+                if mirrored:
+                    child = child.mirrored()
+                result = Searcher(child, COMPUTER, depth, float('inf')).search()
+                entries[key] = result.column
+                child.play(result.column, COMPUTER)
+                if not (child.is_win(COMPUTER) or child.is_full()):
+                    next_frontier[child.canonical_key()[0]] = child
+        logging.info('%d book positions', len(entries))
+        frontier = next_frontier
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=6)
+    parser.add_argument('--columns', type=int, default=7)
+    parser.add_argument('--connect', type=int, default=4)
+    parser.add_argument('--plies', type=int, default=7)
+    parser.add_argument('--depth', type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    entries = build(args.rows, args.columns, args.connect, args.plies,
+                    args.depth)
+    write_book(args.path, args.rows, args.columns, args.connect, entries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""cache.py - Process-wide caches shared by the requests of an instance."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class HitCounter(object):
+    """Thread-safe hit/miss counter"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with a bounded size. If ttl is
+    given entries expire that many seconds after they were set."""
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.counter = HitCounter()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                self.counter.miss()
+                return default
+            if expires is not None and expires < time.time():
+                self.counter.miss()
+                return default
+            self._entries[key] = (value, expires)
+        self.counter.hit()
+        return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+            self._entries[key] = (value, expires)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        stats = self.counter.stats()
+        stats['size'] = len(self._entries)
+        return stats
+
+
+class SingleFlight(object):
+    """Coalesces concurrent identical calls: while a call for a key is
+    running, other threads asking for the same key wait for its result
+    instead of repeating the work. Nothing is cached after the call."""
+
+    def __init__(self):
+        self.counter = HitCounter()
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """Returns a tuple of function(), or the result of the running call
+        for key, and whether the result was shared. Exceptions of the call
+        are raised in every waiting thread."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            self.counter.hit()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        self.counter.miss()
+        try:
+            call.result = function()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        return {'coalesced': self.counter.hits,
+                'calls': self.counter.misses,
+                'in_flight': len(self._calls)}
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
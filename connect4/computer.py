@@ -0,0 +1,74 @@
+"""computer.py - Move selection for the Computer player.
+
+A move is looked up in the opening book first, then in the process-wide LRU
+cache and in memcache. Only if all of them miss the search in ai.py runs, its
+result is stored in both caches. Cached columns are kept in the canonical
+orientation of the position so mirror images share their entries."""
+
+from google.appengine.api import memcache
+
+import ai
+import instrumentation
+from book import OPENING_BOOK
+from cache import HitCounter, LRUCache
+from engine import COMPUTER
+
+MEMCACHE_TIME = 7 * 24 * 60 * 60
+
+book_counter = HitCounter()
+memcache_counter = HitCounter()
+position_cache = LRUCache(max_size=50000)
+
+
+def choose_column(bitboard, difficulty=ai.DEFAULT_DIFFICULTY,
+                  time_limit=None):
+    """Returns the column the Computer plays in the given position. A new
+    search finishes within time_limit seconds if it is given."""
+    if OPENING_BOOK and difficulty != 'EASY' and \
+            OPENING_BOOK.supports(bitboard):
+        column = OPENING_BOOK.lookup(bitboard)
+        if column is not None:
+            book_counter.hit()
+            instrumentation.increment('ai.book_hits')
+            return column
+        book_counter.miss()
+
+    canonical_key, mirrored = bitboard.canonical_key()
+    key = 'ai:{}x{}x{}:{}:{:x}'.format(bitboard.rows, bitboard.columns,
+                                       bitboard.connect, difficulty,
+                                       canonical_key)
+    column = position_cache.get(key)
+    if column is None:
+        column = memcache.get(key)
+        if column is None:
+            memcache_counter.miss()
+            result = ai.choose_column(bitboard, COMPUTER, difficulty,
+                                      time_limit)
+            instrumentation.add_timing('ai.search', result.seconds)
+            instrumentation.increment('ai.search_nodes', result.nodes)
+            column = result.column
+            if mirrored:
+                column = bitboard.columns - 1 - column
+            if time_limit is not None and \
+                    time_limit < ai.DIFFICULTIES[difficulty][1]:
+                # a move found in a shortened search is not cached
+                return result.column
+            memcache.set(key, column, time=MEMCACHE_TIME)
+        else:
+            memcache_counter.hit()
+        position_cache.set(key, column)
+    else:
+        instrumentation.increment('ai.position_cache_hits')
+
+    if mirrored:
+        column = bitboard.columns - 1 - column
+    return column
+
+
+def cache_stats():
+    """Returns the hit/miss counters of the book and both caches"""
+    return {
+        'opening_book': book_counter.stats(),
+        'position_cache': position_cache.stats(),
+        'memcache': memcache_counter.stats(),
+    }
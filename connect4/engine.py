@@ -0,0 +1,202 @@
+"""engine.py - Pure Python bitboard engine for Connect4.
+
+Each player's discs are kept in one integer. Column c uses the bits
+c * (rows + 1) ... c * (rows + 1) + rows - 1, the extra bit on top of every
+column is a sentinel which keeps shifted lines from wrapping into the next
+column. For the default 6x7 board that are 49 bits per player."""
+
+import binascii
+import struct
+
+USER = 0
+COMPUTER = 1
+
+MIN_SIZE = 4
+MAX_SIZE = 20
+MIN_CONNECT = 3
+
+
+def check_size(rows, columns, connect):
+    """Raises ValueError if the board size or connect length is not
+    supported"""
+    if not (MIN_SIZE <= rows <= MAX_SIZE and MIN_SIZE <= columns <= MAX_SIZE):
+        raise ValueError('Rows and columns must be between {} and {}'.format(
+            MIN_SIZE, MAX_SIZE))
+    if not MIN_CONNECT <= connect <= max(rows, columns):
+        raise ValueError('Connect must be between {} and {}'.format(
+            MIN_CONNECT, max(rows, columns)))
+
+
+class Bitboard(object):
+    """Board state of a single game: two player masks plus column heights"""
+
+    def __init__(self, rows=6, columns=7, connect=4):
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.masks = [0, 0]
+        self.heights = [0] * columns
+        self.discs = 0
+
+    @property
+    def column_height(self):
+        """Number of bits used per column (including the sentinel bit)"""
+        return self.rows + 1
+
+    def bottom_mask(self, column):
+        return 1 << (column * self.column_height)
+
+    def cell_mask(self, column, row):
+        return 1 << (column * self.column_height + row)
+
+    def can_play(self, column):
+        """Returns True if the column is on the board and not filled"""
+        return 0 <= column < self.columns and self.heights[column] < self.rows
+
+    def free_columns(self):
+        """Returns the list of columns that can still take a disc"""
+        return [c for c in range(self.columns) if self.heights[c] < self.rows]
+
+    def play(self, column, player):
+        """Drops a disc of player into column and returns the row it landed
+        in. The caller has to make sure that the column is playable."""
+        row = self.heights[column]
+        self.masks[player] |= self.cell_mask(column, row)
+        self.heights[column] = row + 1
+        self.discs += 1
+        return row
+
+    def undo(self, column, player):
+        """Removes the top disc of column, which must belong to player"""
+        row = self.heights[column] - 1
+        self.masks[player] &= ~self.cell_mask(column, row)
+        self.heights[column] = row
+        self.discs -= 1
+        return row
+
+    def cell(self, column, row):
+        """Returns the player owning the cell or None if it is empty"""
+        bit = self.cell_mask(column, row)
+        if self.masks[USER] & bit:
+            return USER
+        if self.masks[COMPUTER] & bit:
+            return COMPUTER
+        return None
+
+    def is_full(self):
+        return self.discs >= self.rows * self.columns
+
+    def is_win(self, player):
+        """Returns True if player has connected enough discs in a line"""
+        bb = self.masks[player]
+        h = self.column_height
+        # vertical, horizontal, / diagonal, \ diagonal
+        for shift in (1, h, h + 1, h - 1):
+            m = bb
+            for i in range(1, self.connect):
+                m &= bb >> (shift * i)
+                if not m:
+                    break
+            if m:
+                return True
+        return False
+
+    def is_win_at(self, column, row, player):
+        """Returns True if the disc of player at column and row is part of a
+        line. Only the lines through that cell are looked at, so the cost
+        depends on the connect length and not on the board size."""
+        bb = self.masks[player]
+        h = self.column_height
+        bit = column * h + row
+        for shift in (1, h, h + 1, h - 1):
+            count = 1
+            # the sentinel bits are never set, so a line ends at the edges
+            position = bit - shift
+            while count < self.connect and position >= 0 and \
+                    bb >> position & 1:
+                count += 1
+                position -= shift
+            position = bit + shift
+            while count < self.connect and bb >> position & 1:
+                count += 1
+                position += shift
+            if count >= self.connect:
+                return True
+        return False
+
+    def position_key(self):
+        """Returns a number that identifies the position on a board of this
+        size: the USER discs plus all discs plus the bottom row. Because the
+        user always moves first the player to move is implied."""
+        occupied = self.masks[USER] | self.masks[COMPUTER]
+        bottom = 0
+        for column in range(self.columns):
+            bottom |= self.bottom_mask(column)
+        return self.masks[USER] + occupied + bottom
+
+    def mirrored(self):
+        """Returns a copy of the board flipped left to right"""
+        board = Bitboard(self.rows, self.columns, self.connect)
+        h = self.column_height
+        column_mask = (1 << h) - 1
+        for column in range(self.columns):
+            target = (self.columns - 1 - column) * h
+            for player in (USER, COMPUTER):
+                bits = (self.masks[player] >> (column * h)) & column_mask
+                board.masks[player] |= bits << target
+        board.heights = self.heights[::-1]
+        board.discs = self.discs
+        return board
+
+    def canonical_key(self):
+        """Returns the smaller position key of the board and its mirror
+        image, together with a flag telling whether the mirror was used"""
+        key = self.position_key()
+        mirror_key = self.mirrored().position_key()
+        if mirror_key < key:
+            return mirror_key, True
+        return key, False
+
+    def copy(self):
+        board = Bitboard(self.rows, self.columns, self.connect)
+        board.masks = list(self.masks)
+        board.heights = list(self.heights)
+        board.discs = self.discs
+        return board
+
+    def pack(self):
+        """Serializes the board into a compact byte string: a header with
+        rows, columns and connect length, the column heights and both player
+        masks as fixed width big endian numbers."""
+        width = self._mask_bytes()
+        data = struct.pack('>BBB', self.rows, self.columns, self.connect)
+        data += struct.pack('>%dB' % self.columns, *self.heights)
+        for mask in self.masks:
+            data += _int_to_bytes(mask, width)
+        return data
+
+    @classmethod
+    def unpack(cls, data):
+        """Builds a Bitboard from a byte string created by pack()"""
+        rows, columns, connect = struct.unpack_from('>BBB', data)
+        board = cls(rows, columns, connect)
+        offset = 3
+        board.heights = list(struct.unpack_from('>%dB' % columns, data,
+                                                offset))
+        offset += columns
+        width = board._mask_bytes()
+        board.masks = [_bytes_to_int(data[offset:offset + width]),
+                       _bytes_to_int(data[offset + width:offset + 2 * width])]
+        board.discs = sum(board.heights)
+        return board
+
+    def _mask_bytes(self):
+        return (self.columns * self.column_height + 7) // 8
+
+
+def _int_to_bytes(value, width):
+    return binascii.unhexlify('%0*x' % (width * 2, value))
+
+
+def _bytes_to_int(data):
+    return int(binascii.hexlify(data), 16) if data else 0
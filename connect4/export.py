@@ -0,0 +1,109 @@
+"""export.py - Rows and file chunks of the nightly data export.
+
+The export task in main.py walks Scores, Games and GameHistoryEntries one
+keys-only page at a time. Every page is turned into rows here, the user
+names are joined with one get_multi per page, and the rows are written as a
+gzip compressed chunk of JSON lines or CSV. Chunks are stored in order and
+concatenated on download, concatenated gzip members are a valid gzip file,
+so a task never holds more than one page in memory."""
+
+import csv
+import gzip
+import json
+from cStringIO import StringIO
+
+import movelog
+from models import Game, GameHistoryEntry, Score, user_names
+
+FORMATS = ('jsonl', 'csv')
+
+
+def _urlsafe(key):
+    return key.urlsafe() if key else None
+
+
+def score_rows(scores):
+    names = user_names([score.user for score in scores])
+    for score in scores:
+        yield {
+            'key': score.key.urlsafe(),
+            'game': _urlsafe(score.key.parent()),
+            'user_name': names.get(score.user),
+            'date': score.date.isoformat(),
+            'won': score.won,
+            'draw': score.draw,
+            'moves': score.moves,
+        }
+
+
+def game_rows(games):
+    names = user_names([game.user for game in games])
+    for game in games:
+        log = None
+        if game.move_log is not None:
+            log = ' '.join(str(move.column) for move in
+                           movelog.decode(game.move_log, game.rows,
+                                          game.columns))
+        yield {
+            'key': game.key.urlsafe(),
+            'user_name': names.get(game.user),
+            'rows': game.rows,
+            'columns': game.columns,
+            'connect': game.connect,
+            'difficulty': game.difficulty,
+            'moves': game.moves,
+            'game_over': game.game_over,
+            'game_canceled': game.game_canceled,
+            'move_log': log,
+        }
+
+
+def history_rows(entries):
+    for entry in entries:
+        yield {
+            'key': entry.key.urlsafe(),
+            'game': _urlsafe(entry.game),
+            'column': entry.column,
+            'row': entry.row,
+            'result': entry.result,
+            'created_at': entry.created_at.isoformat()
+            if entry.created_at else None,
+        }
+
+
+# kind -> (model, CSV columns, row function)
+EXPORTS = {
+    'score': (Score, ['key', 'game', 'user_name', 'date', 'won', 'draw',
+                      'moves'], score_rows),
+    'game': (Game, ['key', 'user_name', 'rows', 'columns', 'connect',
+                    'difficulty', 'moves', 'game_over', 'game_canceled',
+                    'move_log'], game_rows),
+    'history': (GameHistoryEntry, ['key', 'game', 'column', 'row', 'result',
+                                   'created_at'], history_rows),
+}
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def encode_chunk(kind, file_format, entities, header=False):
+    """Returns the gzip compressed rows of the entities of one page. The
+    CSV header is only written into the first chunk of an export."""
+    columns, row_function = EXPORTS[kind][1:]
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+        if file_format == 'csv':
+            writer = csv.writer(out)
+            if header:
+                writer.writerow(columns)
+            for row in row_function(entities):
+                writer.writerow([_csv_value(row[c]) for c in columns])
+        else:
+            for row in row_function(entities):
+                out.write(json.dumps(row, sort_keys=True) + '\n')
+    return buf.getvalue()
@@ -0,0 +1,107 @@
+"""formcache.py - Read-through memcache cache of rendered GameForms.
+
+get_game is polled by clients waiting for their turn. The GameForm of a game
+is kept in memcache under the game key, together with the version of the
+game it was rendered from (Game.version, bumped by every put). Reads fill
+the cache with add(), so they can never replace a newer form, and every
+request that commits a change to a game stores the new form with set()
+right after the commit. make_move and the reaper drop the form instead
+(the worker pool may already have stored the one with the reply of the
+Computer), with a delete that blocks add() for FORGET_LOCK_TIME seconds,
+so a read that loaded the game before the commit cannot put its outdated
+form back. The entries expire after a short time in case a request died
+between its commit and the set.
+
+The version is also the ETag of the form: a client that sends the ETag of
+the form it already has gets a small 'not modified' answer without a single
+datastore RPC."""
+
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+import instrumentation
+from cache import SingleFlight
+from models import GameForm
+
+GAME_FORM_TIME = 60
+# longer than a read takes from its get of the game to its add
+FORGET_LOCK_TIME = 5
+GAME_FOUND = 'Game found!'
+NOT_MODIFIED = 'Not modified'
+
+game_form_flight = SingleFlight()
+
+
+def _cache_key(game_key):
+    return 'game_form:' + game_key.urlsafe()
+
+
+@ndb.tasklet
+def get_game_form_async(game_key):
+    """Returns a Future of the GameForm of the game or None if the game
+    does not exist"""
+    context = ndb.get_context()
+    cache_key = _cache_key(game_key)
+    cached = yield context.memcache_get(cache_key)
+    if cached is not None:
+        instrumentation.increment('game_form_cache.hits')
+        form = protojson.decode_message(GameForm, cached)
+        form.message = GAME_FOUND
+        raise ndb.Return(form)
+
+    instrumentation.increment('game_form_cache.misses')
+    game = yield game_key.get_async()
+    if not game:
+        raise ndb.Return(None)
+    form = yield game.to_form_async(GAME_FOUND)
+    yield context.memcache_add(cache_key, protojson.encode_message(form),
+                               time=GAME_FORM_TIME)
+    raise ndb.Return(form)
+
+
+def get_game_form(game_key):
+    """Returns the GameForm of the game or None like get_game_form_async.
+    Concurrent reads of the same game in this instance share one read, so N
+    clients polling a game at once cost one memcache get (and at most one
+    datastore get). The returned form is shared and must not be changed."""
+    form, shared = game_form_flight.do(
+        game_key.urlsafe(), lambda: get_game_form_async(game_key).get_result())
+    if shared:
+        instrumentation.increment('game_form.coalesced')
+    return form
+
+
+@ndb.tasklet
+def set_game_forms_async(forms):
+    """Stores the GameForms rendered after a commit, the message of the
+    form is replaced when it is read. The sets are batched by ndb."""
+    context = ndb.get_context()
+    sets = []
+    for form in forms:
+        cache_key = _cache_key(ndb.Key(urlsafe=form.urlsafe_key))
+        sets.append(context.memcache_set(cache_key,
+                                         protojson.encode_message(form),
+                                         time=GAME_FORM_TIME))
+    yield sets
+
+
+@ndb.tasklet
+def forget_game_forms_async(game_keys):
+    """Drops the cached forms of games changed without rendering their new
+    form. Reads fill the cache again after FORGET_LOCK_TIME seconds, set()
+    works right away."""
+    context = ndb.get_context()
+    yield [context.memcache_delete(_cache_key(key), seconds=FORGET_LOCK_TIME)
+           for key in game_keys]
+
+
+def not_modified(form):
+    """Returns the short answer for a client that already has the form:
+    the state flags of the game without the board"""
+    return GameForm(urlsafe_key=form.urlsafe_key, moves=form.moves,
+                    game_over=form.game_over,
+                    game_canceled=form.game_canceled, message=NOT_MODIFIED,
+                    user_name=form.user_name, difficulty=form.difficulty,
+                    rows=form.rows, columns=form.columns,
+                    connect=form.connect, etag=form.etag,
+                    ai_pending=form.ai_pending, not_modified=True)
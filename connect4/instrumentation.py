@@ -0,0 +1,213 @@
+"""instrumentation.py - Per-request RPC and timing instrumentation.
+
+Handlers wrapped with @instrumented get a RequestStats object for the
+duration of the request. Hooks on the datastore and memcache RPC layer count
+the calls made by the request and their latency, the game code adds its own
+counters (cache hits, AI search time) with increment() and add_timing().
+When the request ends a structured log line is written and the numbers are
+added to the rolling aggregates of the instance, see aggregates().
+
+Recording only touches a thread-local dict, so it is cheap enough to stay
+enabled under load."""
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from google.appengine.api import apiproxy_stub_map
+
+WINDOW_SECONDS = 300
+BUCKET_SECONDS = 10
+
+_local = threading.local()
+_installed = False
+_install_lock = threading.Lock()
+
+
+class RequestStats(object):
+    """Counters and timings of a single request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.pending = {}
+
+    def record(self, latency, error):
+        return {
+            'handler': self.name,
+            'latency_ms': round(latency * 1000.0, 3),
+            'error': error,
+            'counters': dict(self.counters),
+            'timings_ms': dict((name, round(value * 1000.0, 3))
+                               for name, value in self.timings.items()),
+        }
+
+
+class RollingStats(object):
+    """Aggregates request records per handler in time buckets covering the
+    last WINDOW_SECONDS"""
+
+    def __init__(self, window=WINDOW_SECONDS, bucket=BUCKET_SECONDS):
+        self.window = window
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._buckets = deque()
+
+    def add(self, record, now=None):
+        now = now or time.time()
+        start = int(now // self.bucket) * self.bucket
+        with self._lock:
+            if not self._buckets or self._buckets[-1][0] != start:
+                self._buckets.append((start, {}))
+            while self._buckets and \
+                    self._buckets[0][0] <= now - self.window - self.bucket:
+                self._buckets.popleft()
+            handlers = self._buckets[-1][1]
+            stats = handlers.get(record['handler'])
+            if stats is None:
+                stats = handlers[record['handler']] = _empty_aggregate()
+            _merge(stats, record)
+
+    def snapshot(self, now=None):
+        """Returns the aggregates of every handler within the window"""
+        now = now or time.time()
+        result = {}
+        with self._lock:
+            for start, handlers in self._buckets:
+                if start <= now - self.window - self.bucket:
+                    continue
+                for name, stats in handlers.items():
+                    total = result.get(name)
+                    if total is None:
+                        total = result[name] = _empty_aggregate()
+                    total['requests'] += stats['requests']
+                    total['errors'] += stats['errors']
+                    total['latency_ms'] += stats['latency_ms']
+                    total['max_latency_ms'] = max(total['max_latency_ms'],
+                                                  stats['max_latency_ms'])
+                    for key, value in stats['counters'].items():
+                        total['counters'][key] += value
+                    for key, value in stats['timings_ms'].items():
+                        total['timings_ms'][key] += value
+
+        for stats in result.values():
+            requests = stats['requests']
+            stats['mean_latency_ms'] = stats.pop('latency_ms') / requests
+            stats['counters_per_request'] = dict(
+                (key, float(value) / requests)
+                for key, value in stats.pop('counters').items())
+            stats['timings_ms_per_request'] = dict(
+                (key, value / requests)
+                for key, value in stats.pop('timings_ms').items())
+        return {'window_seconds': self.window, 'handlers': result}
+
+
+def _empty_aggregate():
+    return {'requests': 0, 'errors': 0, 'latency_ms': 0.0,
+            'max_latency_ms': 0.0, 'counters': defaultdict(int),
+            'timings_ms': defaultdict(float)}
+
+
+def _merge(stats, record):
+    stats['requests'] += 1
+    stats['errors'] += 1 if record['error'] else 0
+    stats['latency_ms'] += record['latency_ms']
+    stats['max_latency_ms'] = max(stats['max_latency_ms'],
+                                  record['latency_ms'])
+    for key, value in record['counters'].items():
+        stats['counters'][key] += value
+    for key, value in record['timings_ms'].items():
+        stats['timings_ms'][key] += value
+
+
+rolling_stats = RollingStats()
+
+
+def current():
+    """Returns the RequestStats of the running request or None"""
+    return getattr(_local, 'stats', None)
+
+
+def increment(name, value=1):
+    """Adds value to a counter of the running request"""
+    stats = current()
+    if stats is not None:
+        stats.counters[name] += value
+
+
+def add_timing(name, seconds):
+    """Adds seconds to a timing of the running request"""
+    stats = current()
+    if stats is not None:
+        stats.timings[name] += seconds
+
+
+def _pre_call(service, call, request, response):
+    stats = current()
+    if stats is not None:
+        stats.counters['%s.%s' % (service, call)] += 1
+        stats.pending[id(request)] = time.time()
+
+
+def _post_call(service, call, request, response, *args):
+    stats = current()
+    if stats is None:
+        return
+    start = stats.pending.pop(id(request), None)
+    if start is not None:
+        stats.timings['%s.%s' % (service, call)] += time.time() - start
+    if service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        stats.counters['memcache.hits'] += hits
+        stats.counters['memcache.misses'] += request.key_size() - hits
+
+
+def install():
+    """Registers the RPC hooks once per process"""
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        hooks = apiproxy_stub_map.apiproxy
+        for service in ('datastore_v3', 'memcache'):
+            hooks.GetPreCallHooks().Append('instrumentation', _pre_call,
+                                           service)
+            hooks.GetPostCallHooks().Append('instrumentation', _post_call,
+                                            service)
+        _installed = True
+
+
+def instrumented(name):
+    """Decorator recording the RPCs and timings of a handler as request
+    name. Works for endpoints methods and webapp2 handler methods."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current() is not None:
+                # nested call, the outer handler records everything
+                return func(*args, **kwargs)
+            _local.stats = stats = RequestStats(name)
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = e.__class__.__name__
+                raise
+            finally:
+                _local.stats = None
+                record = stats.record(time.time() - stats.start, error)
+                rolling_stats.add(record)
+                logging.info('request_stats %s',
+                             json.dumps(record, sort_keys=True))
+        return wrapper
+    return decorator
+
+
+def aggregates():
+    """Returns the rolling aggregates of this instance"""
+    return rolling_stats.snapshot()
@@ -0,0 +1,168 @@
+"""leaderboard.py - Precomputed leaderboard snapshots.
+
+/tasks/build_leaderboard (cron, every 30 minutes) reads the UserStats of all
+users with at least MIN_GAMES finished games, the aggregates of their Scores,
+sorts them by win ratio with ties broken by the number of games, and stores
+the rows in LeaderboardChunks of CHUNK_SIZE consecutive ranks. Users with
+the same win ratio and games share a rank. The LeaderboardSnapshot header
+keeps the sort key of the last row of every chunk and is swapped to the new
+run once all of its chunks are written; the chunks of the run before stay
+for readers that still have the old header.
+
+Reads never touch Scores: a page at an offset gets the one or two chunks
+covering it, and the rank of a score is a binary search over the chunk
+bounds and then inside one chunk. Chunks never change once written, they
+are cached in the process together with their sort keys."""
+
+import json
+import logging
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+from cache import LRUCache
+from models import LeaderboardChunk, LeaderboardSnapshot, UserStats, \
+    AI_USER_NAME
+
+MIN_GAMES = 5
+CHUNK_SIZE = 500
+BUILD_BATCH_SIZE = 1000
+HEADER_TIME = 60
+
+Row = namedtuple('Row', ['rank', 'user_name', 'wins', 'losses', 'draws',
+                         'games'])
+Snapshot = namedtuple('Snapshot', ['run', 'built', 'min_games', 'chunk_size',
+                                   'total', 'bounds'])
+
+snapshot_cache = LRUCache(max_size=1, ttl=HEADER_TIME)
+chunk_cache = LRUCache(max_size=200)
+
+
+def sort_key(wins, games):
+    """Leaderboard order: highest win ratio first, then most games"""
+    return -float(wins) / games, -games
+
+
+def build_snapshot():
+    """Builds a new snapshot from the UserStats and makes it the current
+    one. Returns the number of ranked users."""
+    entries = []
+    query = UserStats.query(UserStats.games >= MIN_GAMES)
+    for stats in query.iter(batch_size=BUILD_BATCH_SIZE):
+        if stats.user_name != AI_USER_NAME:
+            entries.append((sort_key(stats.wins, stats.games),
+                            stats.user_name, stats.wins, stats.losses,
+                            stats.draws, stats.games))
+    entries.sort()
+
+    rows = []
+    rank, previous = 0, None
+    for position, entry in enumerate(entries):
+        if entry[0] != previous:
+            rank, previous = position + 1, entry[0]
+        rows.append([rank] + list(entry[1:]))
+
+    header = LeaderboardSnapshot.snapshot_key().get()
+    run = header.run + 1 if header else 1
+    chunks = []
+    bounds = []
+    for index, start in enumerate(range(0, len(rows), CHUNK_SIZE)):
+        chunk_rows = rows[start:start + CHUNK_SIZE]
+        chunks.append(LeaderboardChunk(
+            key=LeaderboardChunk.chunk_key(run, index), run=run,
+            rows=json.dumps(chunk_rows)))
+        last = Row(*chunk_rows[-1])
+        bounds.append([float(last.wins) / last.games, last.games])
+    for i in range(0, len(chunks), 50):
+        ndb.put_multi(chunks[i:i + 50])
+
+    LeaderboardSnapshot(key=LeaderboardSnapshot.snapshot_key(), run=run,
+                        built=datetime.now(), min_games=MIN_GAMES,
+                        chunk_size=CHUNK_SIZE, total=len(rows),
+                        bounds=json.dumps(bounds)).put()
+    outdated = LeaderboardChunk.query(LeaderboardChunk.run < run - 1).fetch(
+        keys_only=True)
+    ndb.delete_multi(outdated)
+    logging.info('Leaderboard run %d: %d users in %d chunks, deleted %d '
+                 'outdated chunks', run, len(rows), len(chunks),
+                 len(outdated))
+    return len(rows)
+
+
+def get_snapshot():
+    """Returns the current Snapshot, with its bounds as sort keys, or None
+    if no leaderboard was built yet"""
+    snapshot = snapshot_cache.get('current')
+    if snapshot is None:
+        header = LeaderboardSnapshot.snapshot_key().get()
+        if not header:
+            return None
+        snapshot = Snapshot(header.run, header.built, header.min_games,
+                            header.chunk_size, header.total,
+                            [(-ratio, -games) for ratio, games in
+                             json.loads(header.bounds)])
+        snapshot_cache.set('current', snapshot)
+    return snapshot
+
+
+def _chunks(snapshot, indexes):
+    """Returns the (rows, sort keys) of the chunks of the snapshot with the
+    given indexes, reading the missing ones with one get_multi"""
+    cache_keys = [(snapshot.run, index) for index in indexes]
+    chunks = dict((key, chunk_cache.get(key)) for key in cache_keys)
+    missing = [key for key in cache_keys if chunks[key] is None]
+    entities = ndb.get_multi([LeaderboardChunk.chunk_key(*key)
+                              for key in missing])
+    for key, entity in zip(missing, entities):
+        if entity is None:
+            raise LookupError('Leaderboard chunk {}:{} is missing'.format(
+                *key))
+        rows = [Row(*row) for row in json.loads(entity.rows)]
+        chunks[key] = (rows, [sort_key(row.wins, row.games) for row in rows])
+        chunk_cache.set(key, chunks[key])
+    return [chunks[key] for key in cache_keys]
+
+
+def page(offset, limit):
+    """Returns the current Snapshot and its Rows at positions offset to
+    offset + limit, e.g. page(0, k) for the top k. The Snapshot is None if
+    no leaderboard was built yet."""
+    snapshot = get_snapshot()
+    if not snapshot or offset >= snapshot.total:
+        return snapshot, []
+    end = min(offset + limit, snapshot.total)
+    first = offset // snapshot.chunk_size
+    last = (end - 1) // snapshot.chunk_size
+    rows = []
+    for chunk_rows, _ in _chunks(snapshot, range(first, last + 1)):
+        rows.extend(chunk_rows)
+    start = offset - first * snapshot.chunk_size
+    return snapshot, rows[start:start + end - offset]
+
+
+def rank_of(wins, games):
+    """Returns the rank the given results have in the current snapshot, or
+    None if they are below the minimum number of games or no leaderboard
+    was built yet. The results of a user may be newer than the snapshot,
+    then this is the rank they would have had in it."""
+    snapshot = get_snapshot()
+    if not snapshot or games < snapshot.min_games:
+        return None
+    key = sort_key(wins, games)
+    index = bisect_left(snapshot.bounds, key)
+    if index == len(snapshot.bounds):
+        return snapshot.total + 1
+    rows, keys = _chunks(snapshot, [index])[0]
+    position = bisect_left(keys, key)
+    if keys[position] == key:
+        # tied with the users at this position
+        return rows[position].rank
+    return index * snapshot.chunk_size + position + 1
+
+
+def cache_stats():
+    """Returns the hit/miss counters of the snapshot and chunk caches"""
+    return {'leaderboard_snapshot': snapshot_cache.stats(),
+            'leaderboard_chunks': chunk_cache.stats()}
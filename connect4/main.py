@@ -2,38 +2,504 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
+from datetime import datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
+import leaderboard
+import movelog
 from api import Connect4Api
+from formcache import forget_game_forms_async, game_form_flight
+from notify import publish_game
+from export import EXPORTS, FORMATS, encode_chunk
+from computer import cache_stats
+from instrumentation import aggregates, install, instrumented
+from ratelimit import rate_limit_stats
+from workers import get_pool, run_job
 
-from models import User
-from models import Game
+from models import User, AI_USER_NAME
+from models import Disc
+from models import ExportChunk
+from models import Game, OPEN
+from models import GameHistoryEntry
+from models import JobCheckpoint
+from models import Score
+from models import UserStats
+from models import user_key_cache
+
+BACKFILL_BATCH_SIZE = 50
+MIGRATION_BATCH_SIZE = 50
+
+REMINDER_JOB = 'send_reminder'
+REMINDER_QUEUE = 'reminders'
+# at most 5 tasks can be enqueued in a transaction: 4 batches + next page
+REMINDER_PAGE_SIZE = 400
+REMINDER_BATCH_SIZE = 100
+
+REAPER_BATCH_SIZE = 100
+REAPER_IDLE_DAYS = 14
+CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+EXPORT_JOB = 'export_{}_{}'
+EXPORT_QUEUE = 'exports'
+EXPORT_PAGE_SIZE = 500
+
+install()
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @instrumented('cron.send_reminder')
     def get(self):
         """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        Called every 12 hours using a cron job. Only starts the fan-out, the
+        users are paged by SendReminderPage. If the previous run did not
+        finish it is continued instead of starting over."""
+        def start():
+            checkpoint = JobCheckpoint.get_or_insert(REMINDER_JOB)
+            if checkpoint.done or checkpoint.run == 0:
+                checkpoint.run += 1
+                checkpoint.cursor = None
+                checkpoint.processed = 0
+                checkpoint.done = False
+                checkpoint.put()
+            taskqueue.add(url='/tasks/send_reminder',
+                          params={'run': checkpoint.run},
+                          queue_name=REMINDER_QUEUE, transactional=True)
+            return checkpoint.run
+
+        run = ndb.transaction(start)
+        logging.info('Reminder run %d started', run)
+
+
+class SendReminderPage(webapp2.RequestHandler):
+    @instrumented('task.send_reminder')
+    def post(self):
+        """Pages through the users with open games (keys only) and enqueues
+        one SendReminderBatch task per batch of users. The cursor is
+        checkpointed together with the enqueued tasks, so a failed or timed
+        out page is retried from where it stopped."""
+        run = int(self.request.get('run'))
+        checkpoint = JobCheckpoint.get_by_id(REMINDER_JOB)
+        if not checkpoint or checkpoint.run != run or checkpoint.done:
+            # an outdated task, e.g. a retry of an already handled page
+            return
+        start_cursor = checkpoint.cursor
+        query = UserStats.query(UserStats.open_games > 0)
+        keys, cursor, more = query.fetch_page(
+            REMINDER_PAGE_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=start_cursor) if start_cursor
+            else None)
+        user_keys = [key.parent().urlsafe() for key in keys]
+
+        def commit():
+            checkpoint = JobCheckpoint.get_by_id(REMINDER_JOB)
+            if checkpoint.run != run or checkpoint.cursor != start_cursor:
+                # another task already handled this page
+                return False
+            for i in range(0, len(user_keys), REMINDER_BATCH_SIZE):
+                taskqueue.add(url='/tasks/send_reminder_batch',
+                              params={'user': user_keys[
+                                  i:i + REMINDER_BATCH_SIZE]},
+                              queue_name=REMINDER_QUEUE, transactional=True)
+            checkpoint.processed += len(keys)
+            if more and cursor:
+                checkpoint.cursor = cursor.urlsafe()
+                taskqueue.add(url='/tasks/send_reminder',
+                              params={'run': run},
+                              queue_name=REMINDER_QUEUE, transactional=True)
+            else:
+                checkpoint.done = True
+            checkpoint.put()
+            return True
+
+        if ndb.transaction(commit):
+            logging.info('Reminder run %d: enqueued %d users', run,
+                         len(keys))
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    @instrumented('task.send_reminder_batch')
+    def post(self):
+        """Sends the reminder emails to one batch of users"""
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
+        user_keys = [ndb.Key(urlsafe=key)
+                     for key in self.request.get_all('user')]
+        stats_keys = [UserStats.key_for(key) for key in user_keys]
+        entities = ndb.get_multi(user_keys + stats_keys)
+        users, stats = entities[:len(user_keys)], entities[len(user_keys):]
+
+        for user, user_stats in zip(users, stats):
+            if not user or not user.email or not user_stats or \
+                    not user_stats.open_games:
+                continue
+            subject = 'This is a reminder!'
+            body = 'Hello {}, you have {} open games in Connect4!'.format(
+                user.name, user_stats.open_games)
+            # This will send test emails, the arguments to send_mail are:
+            # from, to, subject, body
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+    def get(self):
+        """Starts building the UserStats of all users from their Scores.
+        Run once by an admin after deploying UserStats."""
+        taskqueue.add(url='/tasks/backfill_user_stats')
+
+    @instrumented('task.backfill_user_stats')
+    def post(self):
+        """Builds the UserStats of one page of users and enqueues the next
+        page. The Scores and open games come from queries, which are only
+        eventually consistent and cannot run in a transaction, so stats are
+        only created for users that have none yet: stats that exist are
+        kept up to date by every finished game and never overwritten."""
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        users, cursor, more = User.query().fetch_page(BACKFILL_BATCH_SIZE,
+                                                      start_cursor=cursor)
+        existing = ndb.get_multi([UserStats.key_for(user.key)
+                                  for user in users])
+        created = 0
+        for user, current in zip(users, existing):
+            if current or user.name == AI_USER_NAME:
+                continue
+            user_stats = UserStats(key=UserStats.key_for(user.key),
+                                   user=user.key, user_name=user.name)
+            for score in Score.query(Score.user == user.key):
+                user_stats.add_score(score)
             open_games = Game.query(Game.user == user.key)
             open_games = open_games.filter(ndb.AND(Game.game_canceled == False,
                                                    Game.game_over == False))
-            if open_games.count():
-                subject = 'This is a reminder!'
-                body = 'Hello {}, you have open games in Connect4! {}'.format(user.name, open_games.fetch()[0].key)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+            user_stats.open_games = open_games.count()
+            if ndb.transaction(lambda: _create_user_stats(user_stats),
+                               xg=True):
+                created += 1
+        logging.info('Backfilled UserStats of %d of %d users', created,
+                     len(users))
+
+        if more and cursor:
+            taskqueue.add(url='/tasks/backfill_user_stats',
+                          params={'cursor': cursor.urlsafe()})
+
+
+def _create_user_stats(user_stats):
+    """Puts the backfilled stats unless the user got stats in the meantime.
+    Returns whether they were put."""
+    if user_stats.key.get():
+        return False
+    user_stats.put()
+    return True
+
+
+class MigrateGames(webapp2.RequestHandler):
+    def get(self):
+        """Starts converting all games to the packed board in
+        Game.position and the move log in Game.move_log, and sets their
+        status. Run once by an admin after deploying it."""
+        taskqueue.add(url='/tasks/migrate_games')
+
+    @instrumented('task.migrate_games')
+    def post(self):
+        """Migrates one page of games and enqueues the next page"""
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        keys, cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        # the history entries of old games are root entities, so they are
+        # queried and deleted outside of the transaction of their game
+        entry_futures = [GameHistoryEntry.query(
+            GameHistoryEntry.game == key).fetch_async() for key in keys]
+        migrated = 0
+        entry_keys = []
+        for key, entries in zip(keys, entry_futures):
+            entries = entries.get_result()
+            changed, game = ndb.transaction(
+                lambda: _migrate_game(key, entries))
+            if changed:
+                migrated += 1
+            if game is not None and game.move_log is not None:
+                # committed, also cleans up entries left by an earlier run
+                entry_keys.extend(entry.key for entry in entries)
+        ndb.delete_multi(entry_keys)
+        logging.info('Migrated %d of %d games, deleted %d history entries',
+                     migrated, len(keys), len(entry_keys))
+
+        if more and cursor:
+            taskqueue.add(url='/tasks/migrate_games',
+                          params={'cursor': cursor.urlsafe()})
+
+
+def _migrate_game(key, entries):
+    """Builds the position of the game from its Discs and the move log from
+    its GameHistoryEntries, deletes the Discs, drops the old board strings
+    and sets the status. The entries are deleted by the caller once this
+    committed. Returns whether the game changed and the game, which is
+    None if it was deleted since the page was queried."""
+    game = key.get()
+    if game is None:
+        return False, None
+    disc_keys = Disc.query(ancestor=key).fetch(keys_only=True)
+    if game.position and not disc_keys and \
+            'board' not in game._properties and \
+            game.move_log is not None and game.status is not None:
+        return False, game
+
+    if game.status is None:
+        game.status = game.derive_status()
+        # the idle time of old games is unknown, they get a full period
+        game.last_activity = datetime.now()
+
+    bitboard = game.get_bitboard()
+    if 'board' in game._properties:
+        game._clone_properties()
+        del game._properties['board']
+    ndb.delete_multi(disc_keys)
+    if game.move_log is None:
+        if len(entries) == bitboard.discs:
+            entries.sort(key=lambda e: e.created_at)
+            game.move_log = ''.join(movelog.encode(e.column, e.result)
+                                    for e in entries)
+        else:
+            # the query is eventually consistent, try again next run
+            logging.warning('History of game %s incomplete: %d entries, '
+                            '%d discs', key.urlsafe(), len(entries),
+                            bitboard.discs)
+    game.put()
+    return True, game
+
+
+class ReapGames(webapp2.RequestHandler):
+    @instrumented('cron.reap_games')
+    def get(self):
+        """Starts expiring the open games without a move for
+        REAPER_IDLE_DAYS. Called daily by a cron job."""
+        cutoff = datetime.now() - timedelta(days=REAPER_IDLE_DAYS)
+        taskqueue.add(url='/tasks/reap_games',
+                      params={'cutoff': cutoff.strftime(CUTOFF_FORMAT)})
+
+    @instrumented('task.reap_games')
+    def post(self):
+        """Expires one page of idle games, deletes their legacy Discs and
+        enqueues the next page"""
+        cutoff = datetime.strptime(self.request.get('cutoff'),
+                                   CUTOFF_FORMAT)
+        cursor = self.request.get('cursor')
+        query = Game.query(Game.status == OPEN, Game.last_activity < cutoff)
+        keys, cursor, more = query.fetch_page(
+            REAPER_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        disc_queries = [Disc.query(ancestor=key).fetch_async(keys_only=True)
+                        for key in keys]
+        expired = []
+        for key in keys:
+            game = ndb.transaction(lambda: _expire_game(key, cutoff),
+                                   xg=True)
+            if game:
+                expired.append(game)
+                publish_game(game)
+        disc_keys = []
+        for game_key, disc_query in zip(keys, disc_queries):
+            if any(game.key == game_key for game in expired):
+                disc_keys.extend(disc_query.get_result())
+        ndb.delete_multi(disc_keys)
+        forget_game_forms_async([game.key for game in expired]).get_result()
+        logging.info('Expired %d of %d idle games, deleted %d discs',
+                     len(expired), len(keys), len(disc_keys))
+
+        if more and cursor:
+            taskqueue.add(url='/tasks/reap_games',
+                          params={'cutoff': self.request.get('cutoff'),
+                                  'cursor': cursor.urlsafe()})
+
+
+def _expire_game(key, cutoff):
+    """Expires the game if it is still open and idle. Returns the game or
+    None if it changed since the query."""
+    game = key.get()
+    if not game or game.status != OPEN or game.last_activity >= cutoff:
+        return None
+    stats = game.expire()
+    ndb.put_multi([game, stats])
+    return game
+
+
+def _export_args(request):
+    """Returns the kinds and format of an export request, all kinds if no
+    kind is given"""
+    kind = request.get('kind')
+    file_format = request.get('format', 'jsonl')
+    if kind and kind not in EXPORTS or file_format not in FORMATS:
+        webapp2.abort(400, 'Unknown export kind or format')
+    return [kind] if kind else sorted(EXPORTS), file_format
+
+
+class Export(webapp2.RequestHandler):
+    @instrumented('cron.export')
+    def get(self):
+        """Starts the export of one kind (score, game or history) or of all
+        of them as JSON lines or CSV. Called nightly by a cron job. A run
+        that did not finish is continued instead of starting over."""
+        kinds, file_format = _export_args(self.request)
+        for kind in kinds:
+            job = EXPORT_JOB.format(kind, file_format)
+            run = ndb.transaction(lambda: _start_export(job, kind,
+                                                        file_format))
+            logging.info('Export %s run %d started', job, run)
+
+    @instrumented('task.export')
+    def post(self):
+        """Exports one keys-only page of entities into an ExportChunk. The
+        chunk, the checkpoint cursor and the task of the next page are
+        committed together, so an interrupted export resumes at the first
+        page that was not written."""
+        kind = self.request.get('kind')
+        file_format = self.request.get('format')
+        run = int(self.request.get('run'))
+        job = EXPORT_JOB.format(kind, file_format)
+        checkpoint = JobCheckpoint.get_by_id(job)
+        if not checkpoint or checkpoint.run != run or checkpoint.done:
+            return
+        start_cursor = checkpoint.cursor
+        start = checkpoint.processed
+        model = EXPORTS[kind][0]
+        keys, cursor, more = model.query().fetch_page(
+            EXPORT_PAGE_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=start_cursor) if start_cursor
+            else None)
+        entities = [entity for entity in ndb.get_multi(keys) if entity]
+        data = encode_chunk(kind, file_format, entities, header=start == 0)
+
+        def commit():
+            checkpoint = JobCheckpoint.get_by_id(job)
+            if checkpoint.run != run or checkpoint.cursor != start_cursor:
+                # another task already exported this page
+                return False
+            ExportChunk(key=ExportChunk.chunk_key(checkpoint.key, run, start),
+                        run=run, start=start, rows=len(entities),
+                        data=data).put()
+            checkpoint.processed += len(keys)
+            if more and cursor:
+                checkpoint.cursor = cursor.urlsafe()
+                taskqueue.add(url='/tasks/export',
+                              params={'kind': kind, 'format': file_format,
+                                      'run': run},
+                              queue_name=EXPORT_QUEUE, transactional=True)
+            else:
+                checkpoint.done = True
+            checkpoint.put()
+            return checkpoint.done
+
+        if ndb.transaction(commit):
+            # the run is complete, the one before it is not needed anymore
+            old_keys = ExportChunk.query(
+                ExportChunk.run == run - 1,
+                ancestor=ndb.Key(JobCheckpoint, job)).fetch(keys_only=True)
+            ndb.delete_multi(old_keys)
+            logging.info('Export %s run %d finished with %d entities', job,
+                         run, start + len(keys))
+
+
+def _start_export(job, kind, file_format):
+    checkpoint = JobCheckpoint.get_or_insert(job)
+    if checkpoint.done or checkpoint.run == 0:
+        checkpoint.run += 1
+        checkpoint.cursor = None
+        checkpoint.processed = 0
+        checkpoint.done = False
+        checkpoint.put()
+    taskqueue.add(url='/tasks/export',
+                  params={'kind': kind, 'format': file_format,
+                          'run': checkpoint.run},
+                  queue_name=EXPORT_QUEUE, transactional=True)
+    return checkpoint.run
+
+
+class ExportDownload(webapp2.RequestHandler):
+    def get(self):
+        """Returns the gzip file of the last finished run of an export, or
+        of the run given as parameter"""
+        kinds, file_format = _export_args(self.request)
+        if len(kinds) != 1:
+            webapp2.abort(400, 'The kind of the export is required')
+        job = EXPORT_JOB.format(kinds[0], file_format)
+        checkpoint = JobCheckpoint.get_by_id(job)
+        if not checkpoint:
+            webapp2.abort(404, 'Nothing exported yet')
+        run = int(self.request.get('run') or 0) or \
+            (checkpoint.run if checkpoint.done else checkpoint.run - 1)
+        keys = ExportChunk.query(ExportChunk.run == run,
+                                 ancestor=checkpoint.key).fetch(
+            keys_only=True)
+        if not keys:
+            webapp2.abort(404, 'No finished export run')
+        # the ids are zero padded start positions, so they sort in order
+        keys.sort(key=lambda key: key.id())
+
+        self.response.headers['Content-Type'] = 'application/gzip'
+        self.response.headers['Content-Disposition'] = \
+            'attachment; filename="{}_{}.{}.gz"'.format(job, run, file_format)
+        for i in range(0, len(keys), 20):
+            for chunk in ndb.get_multi(keys[i:i + 20]):
+                self.response.write(chunk.data)
+
+
+class BuildLeaderboard(webapp2.RequestHandler):
+    @instrumented('cron.build_leaderboard')
+    def get(self):
+        """Starts building a new leaderboard snapshot. Called every 30
+        minutes by a cron job."""
+        taskqueue.add(url='/tasks/build_leaderboard')
+
+    @instrumented('task.build_leaderboard')
+    def post(self):
+        """Builds the leaderboard snapshot from the UserStats"""
+        leaderboard.build_snapshot()
+
+
+class AiMove(webapp2.RequestHandler):
+    @instrumented('task.ai_move')
+    def post(self):
+        """Computes and commits the reply of the Computer to a user move.
+        Enqueued by the TaskQueuePool of workers.py."""
+        run_job(ndb.Key(urlsafe=self.request.get('game')),
+                int(self.request.get('version')),
+                float(self.request.get('requested')))
+
+
+class AdminStats(webapp2.RequestHandler):
+    def get(self):
+        """Returns the rolling request aggregates, cache counters, AI worker
+        pool metrics, rejected requests per rate limit and coalesced
+        get_game reads of the instance serving the request as JSON"""
+        stats = aggregates()
+        stats['caches'] = cache_stats()
+        stats['caches']['user_key_cache'] = user_key_cache.stats()
+        stats['caches'].update(leaderboard.cache_stats())
+        stats['ai_pool'] = get_pool().stats()
+        stats['rate_limits'] = rate_limit_stats()
+        stats['game_form_flight'] = game_form_flight.stats()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
 
 
 app = webapp2.WSGIApplication([
-    ('/crons/send_reminder', SendReminderEmail)
+    ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminder', SendReminderPage),
+    ('/tasks/send_reminder_batch', SendReminderBatch),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/migrate_games', MigrateGames),
+    ('/tasks/export', Export),
+    ('/tasks/reap_games', ReapGames),
+    ('/tasks/ai_move', AiMove),
+    ('/tasks/build_leaderboard', BuildLeaderboard),
+    ('/admin/export', ExportDownload),
+    ('/admin/stats', AdminStats),
 ], debug=True)
@@ -2,21 +2,80 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
-import random
-from datetime import date
+from datetime import date, datetime
 from protorpc import messages
 from protorpc import message_types
 from google.appengine.ext import ndb
 
+import ai
+import computer
+import instrumentation
+import movelog
+from cache import LRUCache
+from engine import Bitboard, USER, COMPUTER, check_size
+
+AI_USER_NAME = 'Computer'
+
+# Game.status
+OPEN = 'OPEN'
+OVER = 'OVER'
+CANCELED = 'CANCELED'
+EXPIRED = 'EXPIRED'
+
+# user name -> User key, shared by all requests of the instance
+user_key_cache = LRUCache(max_size=10000, ttl=10 * 60)
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Users are keyed by their name, so looking a user up
+    by name is a strongly consistent get."""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
 
+    @classmethod
+    def get_key_by_name(cls, name):
+        """Returns the key of the User with the given name or None"""
+        return cls.get_key_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_key_by_name_async(cls, name):
+        """Async version of get_key_by_name. Found keys are cached, so hot
+        names like the AI user cost no RPC at all."""
+        key = user_key_cache.get(name)
+        if key is not None:
+            instrumentation.increment('user_key_cache.hits')
+        else:
+            instrumentation.increment('user_key_cache.misses')
+            user = yield ndb.Key(cls, name).get_async()
+            if user:
+                key = user.key
+            else:
+                # users created before they were keyed by name
+                key = yield cls.query(cls.name == name).get_async(
+                    keys_only=True)
+            if key:
+                user_key_cache.set(name, key)
+        raise ndb.Return(key)
+
+    @classmethod
+    def get_ai_key_async(cls):
+        """Returns a Future of the key of the Computer user"""
+        return cls.get_key_by_name_async(AI_USER_NAME)
+
+
+def user_names(user_keys):
+    """Resolves the names of the given User keys with a single get_multi.
+    Returns a dict of key -> name."""
+    unique_keys = list(set(user_keys))
+    users = ndb.get_multi(unique_keys)
+    return dict((key, user.name) for key, user in zip(unique_keys, users)
+                if user)
+
 
 class Disc(ndb.Model):
-    """Game Disc"""
+    """Game Disc. Only read to migrate games stored before Game.position
+    held the board."""
     user = ndb.KeyProperty(required=True, kind='User')
     column = ndb.IntegerProperty(required=True)
     row = ndb.IntegerProperty(required=True)
@@ -26,124 +85,259 @@ class Game(ndb.Model):
     """Game object"""
     rows = ndb.IntegerProperty(required=True)
     columns = ndb.IntegerProperty(required=True)
+    connect = ndb.IntegerProperty(required=True, default=4)
     moves = ndb.IntegerProperty(required=True, default=0)
     game_over = ndb.BooleanProperty(required=True, default=False)
     game_canceled = ndb.BooleanProperty(required=True, default=False)
+    # None for games stored before it existed, set by /tasks/migrate_games
+    status = ndb.StringProperty(choices=[OPEN, OVER, CANCELED, EXPIRED])
+    last_activity = ndb.DateTimeProperty()
+    # the reply of the Computer is being computed by the worker pool
+    ai_pending = ndb.BooleanProperty(default=False, indexed=False)
+    ai_requested = ndb.DateTimeProperty(indexed=False)
     user = ndb.KeyProperty(required=True, kind='User')
-    board = ndb.StringProperty(repeated=True)
+    position = ndb.BlobProperty()
+    move_log = ndb.BlobProperty()
+    # bumped by every put, identifies the state a GameForm was rendered from
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    difficulty = ndb.StringProperty(default=ai.DEFAULT_DIFFICULTY,
+                                    choices=sorted(ai.DIFFICULTIES))
 
     @classmethod
-    def new_game(cls, user):
-        """Creates and returns a new game"""
-        game = Game(user=user,
-                    rows=6,
-                    columns=7,
-                    moves=0,
-                    game_canceled=False,
-                    game_over=False,
-                    board=[])
-
-        game.put()
-        return game
-
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def new_game(cls, user, difficulty=ai.DEFAULT_DIFFICULTY, rows=6,
+                 columns=7, connect=4):
+        """Creates and returns a new game. The game is counted as open game
+        of the user in the same transaction. Raises ValueError if the board
+        size is not supported."""
+        check_size(rows, columns, connect)
+
+        def create():
+            game = Game(user=user,
+                        rows=rows,
+                        columns=columns,
+                        connect=connect,
+                        moves=0,
+                        game_canceled=False,
+                        game_over=False,
+                        status=OPEN,
+                        last_activity=datetime.now(),
+                        difficulty=difficulty,
+                        move_log='')
+            game.position = Bitboard(rows, columns, connect).pack()
+            stats = UserStats.get_or_create(user)
+            stats.open_games += 1
+            ndb.put_multi([game, stats])
+            return game
+
+        return ndb.transaction(create, xg=True)
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+    def to_form(self, message, user_name=None):
+        """Returns a GameForm representation of the Game. The user is only
+        fetched if user_name is not given."""
+        return self.to_form_async(message, user_name).get_result()
+
+    @ndb.tasklet
+    def to_form_async(self, message, user_name=None):
+        """Async version of to_form, returns a Future of the GameForm"""
+        if not user_name:
+            user = yield self.user.get_async()
+            user_name = user.name
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name
         form.moves = self.moves
         form.game_over = self.game_over
         form.game_canceled = self.game_canceled
         form.message = message
-        form.board = self.board
-        return form
-
-    def end_game(self, won=False):
+        form.board = self.render_board()
+        form.difficulty = self.difficulty
+        form.rows = self.rows
+        form.columns = self.columns
+        form.connect = self.connect
+        form.etag = str(self.version or 0)
+        form.ai_pending = self.ai_pending
+        raise ndb.Return(form)
+
+    def end_game(self, won=False, draw=False, loaded_stats=None):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost, unless draw is True. Returns the unsaved Score and
+        the updated UserStats, they are written together with the game when
+        the turn is committed. loaded_stats is passed to
+        UserStats.get_or_create."""
         self.game_over = True
-        self.put()
+        self.status = OVER
         # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
-                      moves=self.moves)
-        score.put()
-
-    def store_history_entry(self, column, row, result):
-        history_entry = GameHistoryEntry(game=self.key, column=column, row=row, result=result)
-        history_entry.put()
-
-    def store_game_state(self):
-        # store game state
-        ai_user = User.query(User.name == 'Computer').get()
-        board = [['_' for i in range(self.rows)] for j in range(self.columns)]
-        game_discs = Disc.query(ancestor=self.key).fetch()
-        for disc in game_discs:
-            if disc.user == ai_user.key:
-                board[disc.column][disc.row] = 'X'
+        score = Score(parent=self.key, user=self.user, date=date.today(),
+                      won=won, draw=draw, moves=self.moves)
+        stats = UserStats.get_or_create(self.user, loaded=loaded_stats)
+        stats.add_score(score)
+        stats.close_game()
+        return [score, stats]
+
+    def cancel(self):
+        """Cancels the game and returns the updated UserStats, they have to
+        be written together with the game"""
+        self.game_canceled = True
+        self.ai_pending = False
+        self.status = CANCELED
+        self.last_activity = datetime.now()
+        stats = UserStats.get_or_create(self.user)
+        stats.close_game()
+        return stats
+
+    def expire(self):
+        """Cancels an abandoned game, returns the updated UserStats"""
+        stats = self.cancel()
+        self.status = EXPIRED
+        return stats
+
+    def derive_status(self):
+        """Returns the status matching the flags of the game, for games
+        stored before the status property existed"""
+        if self.game_canceled:
+            return CANCELED
+        if self.game_over:
+            return OVER
+        return OPEN
+
+    def log_move(self, column, row, result):
+        """Appends the move to the move log of the game. Games started
+        before the log existed keep their GameHistoryEntry entities until
+        they are migrated, for them an unsaved entry is returned."""
+        self.last_activity = datetime.now()
+        if self.move_log is None:
+            return GameHistoryEntry(parent=self.key, game=self.key,
+                                    column=column, row=row, result=result)
+        self.move_log += movelog.encode(column, result)
+
+    def history_forms(self):
+        """Returns the GameHistoryForms of all moves in the move log"""
+        return [GameHistoryForm(ply=move.ply, column=move.column,
+                                row=move.row, result=move.result)
+                for move in movelog.decode(self.move_log, self.rows,
+                                           self.columns)]
+
+    def replay(self, ply):
+        """Returns the Bitboard of the game after the first ply half-moves"""
+        return movelog.replay(self.move_log, self.rows, self.columns,
+                              self.connect, ply)
+
+    def get_bitboard(self):
+        """Returns the Bitboard of this game. Games created before the
+        position property existed are rebuilt once from their Discs."""
+        if getattr(self, '_bitboard', None) is None:
+            if self.position:
+                self._bitboard = Bitboard.unpack(self.position)
             else:
-                board[disc.column][disc.row] = 'O'
-
-        self.board = [' '.join([str(c) for c in lst]) for lst in board]
-
-    def get_free_column(self):
+                self._bitboard = Bitboard(self.rows, self.columns,
+                                          self.connect)
+                game_discs = Disc.query(ancestor=self.key).fetch()
+                for disc in sorted(game_discs, key=lambda d: d.row):
+                    player = USER if disc.user == self.user else COMPUTER
+                    self._bitboard.play(disc.column, player)
+                self.position = self._bitboard.pack()
+        return self._bitboard
+
+    def player_of(self, user):
+        """Maps a User key to the engine player constant"""
+        return USER if user == self.user else COMPUTER
+
+    def drop_disc(self, user, column):
+        """Puts a disc of the given user into column and returns the row it
+        landed in"""
+        bitboard = self.get_bitboard()
+        row = bitboard.play(column, self.player_of(user))
+        self.position = bitboard.pack()
+        return row
+
+    def render_board(self, bitboard=None):
+        """Renders the board for the GameForm, one string per column with
+        'O' for discs of the user, 'X' for the Computer and '_' if empty.
+        Renders the current position unless another bitboard is given."""
+        if bitboard is None:
+            bitboard = self.get_bitboard()
+        board = [['_' for i in range(self.rows)] for j in range(self.columns)]
+        for column in range(self.columns):
+            for row in range(bitboard.heights[column]):
+                if bitboard.cell(column, row) == COMPUTER:
+                    board[column][row] = 'X'
+                else:
+                    board[column][row] = 'O'
 
-        rows_filled = self.rows
-        column = -1
-        while rows_filled >= self.rows:
-            column = random.randrange(0, self.columns)
-            game_discs = Disc.query(ancestor=self.key)
-            game_discs = game_discs.filter(Disc.column == column)
-            rows_filled = game_discs.count()
+        return [' '.join([str(c) for c in lst]) for lst in board]
 
-        return column
+    def get_ai_column(self, time_limit=None):
+        """Searches the column for the next move of the Computer, within
+        time_limit seconds if it is given"""
+        return computer.choose_column(self.get_bitboard(), self.difficulty,
+                                      time_limit)
 
     def check_full(self):
-        return Disc.query(ancestor=self.key).count() >= (self.columns * self.rows)
+        return self.get_bitboard().is_full()
+
+    def check_win(self, user, column=None, row=None):
+        """Returns True if user has a line. If the cell of the last disc of
+        user is given only the lines through it are checked."""
+        bitboard = self.get_bitboard()
+        if column is None:
+            return bitboard.is_win(self.player_of(user))
+        return bitboard.is_win_at(column, row, self.player_of(user))
+
+
+class JobCheckpoint(ndb.Model):
+    """Progress of a long running, task chained job. Keyed by job name, the
+    cursor points at the next page to process."""
+    run = ndb.IntegerProperty(required=True, default=0)
+    cursor = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class ExportChunk(ndb.Model):
+    """One gzip compressed page of an export run. Stored as child of the
+    JobCheckpoint of the export, so a chunk and the checkpoint advancing
+    past its page are written in one transaction."""
+    run = ndb.IntegerProperty(required=True)
+    start = ndb.IntegerProperty(required=True, indexed=False)
+    rows = ndb.IntegerProperty(required=True, indexed=False)
+    data = ndb.BlobProperty(required=True)
 
-    def check_win(self, user):
-
-        tile = user
-
-        # create game board
-        board = [[0 for i in range(self.rows)] for j in range(self.columns)]
-
-        # fill game board
-        game_discs = Disc.query(ancestor=self.key).fetch()
-        for disc in game_discs:
-            board[disc.column][disc.row] = disc.user
-
-        boardHeight = len(board[0])
-        boardWidth = len(board)
-
-        # check horizontal spaces
-        for y in range(boardHeight):
-            for x in range(boardWidth - 3):
-                if board[x][y] == tile and board[x + 1][y] == tile and board[x + 2][y] == tile and board[x + 3][
-                    y] == tile:
-                    return True
+    @classmethod
+    def chunk_key(cls, checkpoint_key, run, start):
+        return ndb.Key(cls, '{}:{:010d}'.format(run, start),
+                       parent=checkpoint_key)
+
+
+class LeaderboardSnapshot(ndb.Model):
+    """Header of the leaderboard snapshot in use, a single entity. bounds
+    holds the sort key (win ratio, games) of the last row of every chunk
+    as JSON, so the chunk of a rank or a score is found without reading
+    the chunks."""
+    run = ndb.IntegerProperty(required=True, indexed=False)
+    built = ndb.DateTimeProperty(required=True, indexed=False)
+    min_games = ndb.IntegerProperty(required=True, indexed=False)
+    chunk_size = ndb.IntegerProperty(required=True, indexed=False)
+    total = ndb.IntegerProperty(required=True, indexed=False)
+    bounds = ndb.BlobProperty(required=True)
 
-        # check vertical spaces
-        for x in range(boardWidth):
-            for y in range(boardHeight - 3):
-                if board[x][y] == tile and board[x][y + 1] == tile and board[x][y + 2] == tile and board[x][
-                            y + 3] == tile:
-                    return True
+    @classmethod
+    def snapshot_key(cls):
+        return ndb.Key(cls, 'leaderboard')
 
-        # check / diagonal spaces
-        for x in range(boardWidth - 3):
-            for y in range(3, boardHeight):
-                if board[x][y] == tile and board[x + 1][y - 1] == tile and board[x + 2][y - 2] == tile and \
-                                board[x + 3][y - 3] == tile:
-                    return True
 
-        # check \ diagonal spaces
-        for x in range(boardWidth - 3):
-            for y in range(boardHeight - 3):
-                if board[x][y] == tile and board[x + 1][y + 1] == tile and board[x + 2][y + 2] == tile and \
-                                board[x + 3][y + 3] == tile:
-                    return True
+class LeaderboardChunk(ndb.Model):
+    """chunk_size consecutive rows of a leaderboard snapshot run as JSON
+    list of [rank, user_name, wins, losses, draws, games]"""
+    run = ndb.IntegerProperty(required=True)
+    rows = ndb.BlobProperty(required=True, compressed=True)
 
-        return False
+    @classmethod
+    def chunk_key(cls, run, index):
+        return ndb.Key(cls, '{}:{:06d}'.format(run, index))
 
 
 class Score(ndb.Model):
@@ -151,15 +345,73 @@ class Score(ndb.Model):
     user = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
+    draw = ndb.BooleanProperty(default=False)
     moves = ndb.IntegerProperty(required=True)
 
+    def to_form(self, user_name=None):
+        return ScoreForm(user_name=user_name or self.user.get().name,
+                         won=self.won, date=str(self.date), moves=self.moves)
+
+
+class UserStats(ndb.Model):
+    """Aggregated results of a user, kept up to date by Game.end_game.
+    Stored as child of the User so every user has exactly one."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(required=True, indexed=False)
+    games = ndb.IntegerProperty(required=True, default=0)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    losses = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    draws = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    total_moves = ndb.IntegerProperty(required=True, default=0,
+                                      indexed=False)
+    open_games = ndb.IntegerProperty(required=True, default=0)
+    win_ratio = ndb.ComputedProperty(
+        lambda self: float(self.wins) / self.games if self.games else 0.0)
+
+    @staticmethod
+    def key_for(user):
+        return ndb.Key(UserStats, 1, parent=user)
+
+    @classmethod
+    def get_or_create(cls, user, user_name=None, loaded=None):
+        """Returns the stats of the given User key, a new empty entity is
+        returned (but not saved) if the user has none yet. loaded is an
+        optional dict of user key -> stats already used in the running
+        transaction, so every change there updates the same entity."""
+        if loaded is not None and user in loaded:
+            return loaded[user]
+        stats = cls.key_for(user).get()
+        if not stats:
+            if user_name is None:
+                user_name = user.get().name
+            stats = cls(key=cls.key_for(user), user=user, user_name=user_name)
+        if loaded is not None:
+            loaded[user] = stats
+        return stats
+
+    def add_score(self, score):
+        self.games += 1
+        self.total_moves += score.moves
+        if score.won:
+            self.wins += 1
+        elif score.draw:
+            self.draws += 1
+        else:
+            self.losses += 1
+
+    def close_game(self):
+        """Removes a game that ended or got canceled from the open games"""
+        self.open_games = max(0, self.open_games - 1)
+
     def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
-                         date=str(self.date), moves=self.moves)
+        return RankingForm(user_name=self.user_name, win_ration=self.win_ratio,
+                           games=self.games, wins=self.wins,
+                           losses=self.losses, draws=self.draws)
 
 
 class GameHistoryEntry(ndb.Model):
-    """Game history object"""
+    """Game history object. Only written for games started before the
+    history was kept in Game.move_log."""
     game = ndb.KeyProperty(required=True, kind='Game')
     column = ndb.IntegerProperty(required=True)
     row = ndb.IntegerProperty(required=True)
@@ -172,17 +424,29 @@ class GameHistoryEntry(ndb.Model):
 
 
 class GameHistoryForm(messages.Message):
-    """GameHistoryForm for outbound game history information"""
-    urlsafe_key = messages.StringField(1, required=True)
+    """GameHistoryForm for outbound game history information. urlsafe_key
+    and created_at are only set for moves of not yet migrated games."""
+    urlsafe_key = messages.StringField(1)
     column = messages.IntegerField(2, required=True)
     row = messages.IntegerField(3, required=True)
     result = messages.StringField(4, required=True)
     created_at = message_types.DateTimeField(5)
+    ply = messages.IntegerField(6)
 
 
 class GameHistoryForms(messages.Message):
     """Return multiple GameHistoryForms"""
     items = messages.MessageField(GameHistoryForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class ReplayForm(messages.Message):
+    """The board of a game after a number of half-moves"""
+    urlsafe_key = messages.StringField(1, required=True)
+    ply = messages.IntegerField(2, required=True)
+    plies = messages.IntegerField(3, required=True)
+    board = messages.StringField(4, repeated=True)
+    result = messages.StringField(5)
 
 
 class GameForm(messages.Message):
@@ -194,16 +458,36 @@ class GameForm(messages.Message):
     message = messages.StringField(5, required=True)
     user_name = messages.StringField(6, required=True)
     board = messages.StringField(7, repeated=True)
+    difficulty = messages.StringField(8)
+    rows = messages.IntegerField(9)
+    columns = messages.IntegerField(10)
+    connect = messages.IntegerField(11)
+    etag = messages.StringField(12)
+    not_modified = messages.BooleanField(13)
+    ai_pending = messages.BooleanField(14)
 
 
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class Difficulty(messages.Enum):
+    """Strength of the Computer player"""
+    EASY = 1
+    MEDIUM = 2
+    HARD = 3
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
+    difficulty = messages.EnumField(Difficulty, 2,
+                                    default=ai.DEFAULT_DIFFICULTY)
+    rows = messages.IntegerField(3, default=6)
+    columns = messages.IntegerField(4, default=7)
+    connect = messages.IntegerField(5, default=4)
 
 
 class MakeMoveForm(messages.Message):
@@ -211,6 +495,31 @@ class MakeMoveForm(messages.Message):
     move_column = messages.IntegerField(1, required=True)
 
 
+class MoveForm(messages.Message):
+    """A single move of a MakeMovesForm"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    move_column = messages.IntegerField(2, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make several moves, in one or more games, at once"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """Outcome of one move of a MakeMovesForm. game holds the state of the
+    game after the whole batch."""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    status = messages.StringField(2, required=True)
+    message = messages.StringField(3, required=True)
+    game = messages.MessageField(GameForm, 4)
+
+
+class MoveResultForms(messages.Message):
+    """Return multiple MoveResultForms"""
+    items = messages.MessageField(MoveResultForm, 1, repeated=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -222,17 +531,39 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class RankingForm(messages.Message):
     """RankingForm for outbound ranking information"""
     user_name = messages.StringField(1, required=True)
     win_ration = messages.FloatField(2, required=True)
+    games = messages.IntegerField(3)
+    wins = messages.IntegerField(4)
+    losses = messages.IntegerField(5)
+    draws = messages.IntegerField(6)
+    rank = messages.IntegerField(7)
 
 
 class RankingForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(RankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    total = messages.IntegerField(3)
+    built = message_types.DateTimeField(4)
+
+
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm for outbound hit/miss counters of one cache"""
+    name = messages.StringField(1, required=True)
+    hits = messages.IntegerField(2, required=True)
+    misses = messages.IntegerField(3, required=True)
+    size = messages.IntegerField(4)
+
+
+class CacheStatsForms(messages.Message):
+    """Return multiple CacheStatsForms"""
+    items = messages.MessageField(CacheStatsForm, 1, repeated=True)
 
 
 class StringMessage(messages.Message):
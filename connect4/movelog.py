@@ -0,0 +1,55 @@
+"""movelog.py - Compact move log of a game.
+
+Every half-move is stored as one byte, the column in the low five bits and a
+result code in the high three bits. The user always moves first, so the
+player of a move follows from its position in the log, and the row a disc
+landed in follows from replaying the columns before it."""
+
+from collections import namedtuple
+
+from engine import Bitboard, USER, COMPUTER
+
+COLUMN_BITS = 5
+COLUMN_MASK = (1 << COLUMN_BITS) - 1
+
+# result code -> result string of the history, the index is stored
+RESULTS = (
+    'player made move',
+    'Computer made move',
+    'won',
+    'game lost',
+    'game ended with no winner',
+)
+
+Move = namedtuple('Move', ['ply', 'player', 'column', 'row', 'result'])
+
+
+def encode(column, result):
+    """Returns the log byte of a move into column with the given result"""
+    if column > COLUMN_MASK:
+        raise ValueError('Column {} does not fit into the log'.format(column))
+    return chr(RESULTS.index(result) << COLUMN_BITS | column)
+
+
+def decode(log, rows, columns):
+    """Returns the list of Moves stored in the log"""
+    heights = [0] * columns
+    moves = []
+    for ply, value in enumerate(bytearray(log or '')):
+        column = value & COLUMN_MASK
+        moves.append(Move(ply + 1, COMPUTER if ply % 2 else USER, column,
+                          heights[column], RESULTS[value >> COLUMN_BITS]))
+        heights[column] += 1
+    return moves
+
+
+def replay(log, rows, columns, connect, ply=None):
+    """Returns the Bitboard after the first ply half-moves of the log, or
+    after all of them if ply is None"""
+    bitboard = Bitboard(rows, columns, connect)
+    values = bytearray(log or '')
+    if ply is not None:
+        values = values[:ply]
+    for index, value in enumerate(values):
+        bitboard.play(value & COLUMN_MASK, COMPUTER if index % 2 else USER)
+    return bitboard
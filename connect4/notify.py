@@ -0,0 +1,136 @@
+"""notify.py - Change notifications for long-polling clients.
+
+Requests that commit a change to a game publish the new Game.version on the
+topic of the game, poll_game waits on that topic until a version newer than
+the client's shows up. The Channel is pluggable: MemcacheChannel works across
+all instances of the app and is used when deployed, LocalChannel keeps the
+versions in the process and wakes waiters immediately, for the development
+server and local tests. set_channel() replaces the channel in use."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+from utils import Backend
+
+VERSION_TIME = 60 * 60
+
+
+class Channel(object):
+    """Publishes increasing version numbers per topic"""
+
+    def publish(self, topic, version):
+        """Announces version of topic, older versions are ignored"""
+        raise NotImplementedError()
+
+    def latest(self, topic):
+        """Returns the newest published version of topic or None"""
+        raise NotImplementedError()
+
+    def wait(self, topic, version, timeout):
+        """Blocks until a version of topic newer than version is published
+        or timeout seconds passed. Returns the newer version or None."""
+        raise NotImplementedError()
+
+
+class LocalChannel(Channel):
+    """In-process channel, only sees the publishes of its own instance"""
+
+    def __init__(self, max_topics=10000):
+        self.max_topics = max_topics
+        self._condition = threading.Condition()
+        self._versions = OrderedDict()
+
+    def publish(self, topic, version):
+        with self._condition:
+            current = self._versions.pop(topic, None)
+            if current is not None and current > version:
+                version = current
+            if len(self._versions) >= self.max_topics:
+                self._versions.popitem(last=False)
+            self._versions[topic] = version
+            self._condition.notify_all()
+
+    def latest(self, topic):
+        with self._condition:
+            return self._versions.get(topic)
+
+    def wait(self, topic, version, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                current = self._versions.get(topic)
+                if current is not None and current > version:
+                    return current
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+
+class MemcacheChannel(Channel):
+    """Keeps the latest version of every topic in memcache. Waiting polls
+    memcache with a growing interval, which costs a fraction of a get_game
+    poll of the client."""
+
+    def __init__(self, poll_interval=0.1, max_poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    def _key(self, topic):
+        return 'version:' + topic
+
+    def publish(self, topic, version):
+        key = self._key(topic)
+        client = memcache.Client()
+        # compare and set, so a late publish never lowers the version
+        for _ in range(10):
+            current = client.gets(key)
+            if current is None:
+                if client.add(key, version, time=VERSION_TIME):
+                    return
+            elif current >= version:
+                return
+            elif client.cas(key, version, time=VERSION_TIME):
+                return
+
+    def latest(self, topic):
+        return memcache.get(self._key(topic))
+
+    def wait(self, topic, version, timeout):
+        deadline = time.time() + timeout
+        interval = self.poll_interval
+        while True:
+            current = self.latest(topic)
+            if current is not None and current > version:
+                return current
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.max_poll_interval)
+
+
+_channel = Backend(MemcacheChannel, LocalChannel)
+
+
+def get_channel():
+    """Returns the channel in use, memcache when deployed and in-process
+    otherwise"""
+    return _channel.get()
+
+
+def set_channel(channel):
+    """Replaces the channel, e.g. with a LocalChannel in tests"""
+    _channel.set(channel)
+
+
+def game_topic(game_key):
+    return 'game:' + game_key.urlsafe()
+
+
+def publish_game(game):
+    """Announces the committed version of a game"""
+    get_channel().publish(game_topic(game.key), game.version or 0)
@@ -0,0 +1,192 @@
+"""ratelimit.py - Token bucket rate limits per game and per client.
+
+A client hammering make_move, make_moves or get_game on one game makes all
+requests on that entity group contend. Every such request takes a token from
+the bucket of the game and from the bucket of the client (its remote address,
+the API has no sign-in) before it touches the datastore. A bucket holds up to
+burst tokens and refills with rate tokens per second; a request finding an
+empty bucket is rejected with HTTP 429.
+
+The Limiter is pluggable like the notify channel: MemcacheLimiter shares the
+buckets of all instances and is used when deployed, LocalLimiter keeps them
+in the process, for the development server and local tests. set_limiter()
+replaces the limiter in use."""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import endpoints
+from google.appengine.api import memcache
+
+import instrumentation
+from cache import HitCounter
+from utils import Backend
+
+# tokens per second, bucket size
+Limit = namedtuple('Limit', ['rate', 'burst'])
+
+LIMITS = {
+    'make_move.game': Limit(2.0, 5),
+    'make_move.client': Limit(5.0, 20),
+    'get_game.game': Limit(10.0, 30),
+    'get_game.client': Limit(10.0, 30),
+}
+
+# requests rejected (hits) and allowed (misses) per limit
+counters = dict((name, HitCounter()) for name in LIMITS)
+
+
+class RateLimitedException(endpoints.ServiceException):
+    """Too many requests, HTTP 429"""
+    http_status = 429
+
+
+def _take(state, limit, now):
+    """Returns the (tokens, time) state of a bucket after taking one token
+    at now, or None if the bucket is empty. A missing state is a full
+    bucket."""
+    if state is None:
+        tokens = limit.burst
+    else:
+        tokens, last = state
+        tokens = min(limit.burst, tokens + (now - last) * limit.rate)
+    if tokens < 1:
+        return None
+    return tokens - 1, now
+
+
+class Limiter(object):
+    """Takes tokens from several buckets at once"""
+
+    def take(self, buckets):
+        """Takes one token from each of the buckets, given as list of
+        (key, Limit). Returns None, or the key of an empty bucket without
+        taking any token."""
+        raise NotImplementedError()
+
+
+class LocalLimiter(Limiter):
+    """In-process buckets, only limits the requests of its own instance"""
+
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+
+    def take(self, buckets):
+        now = time.time()
+        with self._lock:
+            states = []
+            for key, limit in buckets:
+                state = _take(self._states.get(key), limit, now)
+                if state is None:
+                    return key
+                states.append((key, state))
+            for key, state in states:
+                self._states.pop(key, None)
+                if len(self._states) >= self.max_buckets:
+                    self._states.popitem(last=False)
+                self._states[key] = state
+        return None
+
+
+class MemcacheLimiter(Limiter):
+    """Keeps the buckets in memcache, one get_multi and one cas_multi (and
+    add_multi for new buckets) per request. A bucket left alone until it is
+    full again expires, a missing bucket counts as full. Requests are
+    allowed when the buckets stay contended or memcache fails, the limits
+    protect the datastore but must not take the game down."""
+
+    def __init__(self, attempts=3):
+        self.attempts = attempts
+
+    def take(self, buckets):
+        client = memcache.Client()
+        pending = dict(('ratelimit:' + key, (key, limit))
+                       for key, limit in buckets)
+        expires = max(int(limit.burst / limit.rate) + 1
+                      for _, limit in buckets)
+        for _ in range(self.attempts):
+            now = time.time()
+            current = client.get_multi(pending.keys(), for_cas=True)
+            changed, added = {}, {}
+            for cache_key, (key, limit) in pending.items():
+                state = _take(current.get(cache_key), limit, now)
+                if state is None:
+                    return key
+                if cache_key in current:
+                    changed[cache_key] = state
+                else:
+                    added[cache_key] = state
+            failed = []
+            if changed:
+                failed.extend(client.cas_multi(changed, time=expires))
+            if added:
+                failed.extend(client.add_multi(added, time=expires))
+            if not failed:
+                return None
+            # another request changed these buckets in the meantime, the
+            # tokens already taken from the others stay taken
+            pending = dict((cache_key, pending[cache_key])
+                           for cache_key in failed)
+        logging.warning('Rate limit buckets stayed contended: %s',
+                        ', '.join(key for key, _ in pending.values()))
+        return None
+
+
+_limiter = Backend(MemcacheLimiter, LocalLimiter)
+
+
+def get_limiter():
+    """Returns the limiter in use, memcache when deployed and in-process
+    otherwise"""
+    return _limiter.get()
+
+
+def set_limiter(limiter):
+    """Replaces the limiter, e.g. with a LocalLimiter in tests"""
+    _limiter.set(limiter)
+
+
+def check_rate(endpoint, game_key, client):
+    """Takes a token for the request of client on the game from the game
+    and client buckets of endpoint.
+
+    Raises:
+        RateLimitedException: If one of the buckets is empty.
+    """
+    check_rates(endpoint, [game_key], client)
+
+
+def check_rates(endpoint, game_keys, client):
+    """Takes a token for the request of client on several games, from the
+    bucket of every game and once from the client bucket of endpoint. No
+    token is taken if one of the buckets is empty.
+
+    Raises:
+        RateLimitedException: If one of the buckets is empty.
+    """
+    game_limit, client_limit = endpoint + '.game', endpoint + '.client'
+    buckets = [(game_limit + ':' + key.urlsafe(), game_limit)
+               for key in game_keys]
+    buckets.append((client_limit + ':' + client, client_limit))
+    empty = get_limiter().take([(key, LIMITS[name])
+                                for key, name in buckets])
+    if empty is None:
+        for _ in game_keys:
+            counters[game_limit].miss()
+        counters[client_limit].miss()
+        return
+    counters[dict(buckets)[empty]].hit()
+    instrumentation.increment('ratelimit.rejected')
+    logging.info('Rate limited %s', empty)
+    raise RateLimitedException(
+        'Too many requests, please slow down!')
+
+
+def rate_limit_stats():
+    """Returns the rejected/allowed counters of every limit"""
+    return dict((name, {'rejected': counter.hits, 'allowed': counter.misses})
+                for name, counter in counters.items())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""simulate.py - Datastore free self-play for tuning the Computer player.
+
+Plays games between two strategies with the same rules as the game (the
+Bitboard engine) and the same search as the Computer (ai.py). Games run in
+batches on a process pool, every finished game is streamed as one JSON line,
+a summary line with games/sec and win/draw rates per strategy and board size
+closes the output.
+
+    python simulate.py --games 1000 --first random --second EASY \\
+        --size 6x7 --size 5x6 --processes 4 --output results.jsonl
+
+Strategies: random, center, EASY, MEDIUM, HARD (the difficulties of the
+Computer, with their time budgets) and depthN (fixed depth search without a
+time budget, e.g. depth4)."""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import time
+from collections import defaultdict
+
+import ai
+from engine import Bitboard, USER, COMPUTER
+
+
+def random_strategy(bitboard, player, rng):
+    return rng.choice(bitboard.free_columns())
+
+
+def center_strategy(bitboard, player, rng):
+    for column in ai.center_order(bitboard.columns):
+        if bitboard.can_play(column):
+            return column
+
+
+def search_strategy(max_depth, time_budget):
+    def strategy(bitboard, player, rng):
+        return ai.Searcher(bitboard, player, max_depth,
+                           time_budget).search().column
+    return strategy
+
+
+def get_strategy(name):
+    """Returns the move function of a strategy name"""
+    if name == 'random':
+        return random_strategy
+    if name == 'center':
+        return center_strategy
+    if name in ai.DIFFICULTIES:
+        return search_strategy(*ai.DIFFICULTIES[name])
+    if name.startswith('depth') and name[5:].isdigit():
+        return search_strategy(int(name[5:]), float('inf'))
+    raise ValueError('Unknown strategy {}'.format(name))
+
+
+def play_game(rows, columns, connect, first, second, rng):
+    """Plays one game, first moves as USER and starts. Returns the winning
+    strategy position ('first' or 'second', None for a draw) and the number
+    of plies."""
+    bitboard = Bitboard(rows, columns, connect)
+    players = ((USER, first, 'first'), (COMPUTER, second, 'second'))
+    while True:
+        for player, strategy, position in players:
+            column = strategy(bitboard, player, rng)
+            row = bitboard.play(column, player)
+            if bitboard.is_win_at(column, row, player):
+                return position, bitboard.discs
+            if bitboard.is_full():
+                return None, bitboard.discs
+
+
+def play_batch(args):
+    """Plays one batch of games, runs in a worker process"""
+    first_index, count, rows, columns, connect, first, second, seed = args
+    rng = random.Random(seed)
+    first_strategy = get_strategy(first)
+    second_strategy = get_strategy(second)
+    records = []
+    for index in range(first_index, first_index + count):
+        start = time.time()
+        winner, plies = play_game(rows, columns, connect, first_strategy,
+                                  second_strategy, rng)
+        records.append({
+            'game': index,
+            'rows': rows,
+            'columns': columns,
+            'connect': connect,
+            'first': first,
+            'second': second,
+            'winner': winner,
+            'plies': plies,
+            'seconds': round(time.time() - start, 6),
+        })
+    return records
+
+
+def batches(games, batch_size, sizes, connect, first, second, seed):
+    """Splits the games of every board size into worker batches"""
+    index = 0
+    for rows, columns in sizes:
+        for start in range(0, games, batch_size):
+            count = min(batch_size, games - start)
+            yield (index, count, rows, columns, connect, first, second,
+                   seed * 1000003 + index)
+            index += count
+
+
+def summarize(records, seconds):
+    groups = defaultdict(lambda: {'games': 0, 'first': 0, 'second': 0,
+                                  'draws': 0, 'plies': 0})
+    for record in records:
+        key = '{} vs {} {}x{} connect {}'.format(
+            record['first'], record['second'], record['rows'],
+            record['columns'], record['connect'])
+        group = groups[key]
+        group['games'] += 1
+        group['plies'] += record['plies']
+        if record['winner']:
+            group[record['winner']] += 1
+        else:
+            group['draws'] += 1
+
+    matchups = {}
+    for key, group in groups.items():
+        games = float(group['games'])
+        matchups[key] = {
+            'games': group['games'],
+            'first_win_rate': group['first'] / games,
+            'second_win_rate': group['second'] / games,
+            'draw_rate': group['draws'] / games,
+            'mean_plies': group['plies'] / games,
+        }
+    return {
+        'summary': True,
+        'games': len(records),
+        'seconds': seconds,
+        'games_per_second': len(records) / seconds if seconds else None,
+        'matchups': matchups,
+    }
+
+
+def parse_size(value):
+    rows, columns = value.lower().split('x')
+    return int(rows), int(columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=100,
+                        help='games per board size')
+    parser.add_argument('--first', default='random',
+                        help='strategy of the starting player')
+    parser.add_argument('--second', default='EASY',
+                        help='strategy of the second player')
+    parser.add_argument('--size', type=parse_size, action='append',
+                        help='board size as ROWSxCOLUMNS, default 6x7')
+    parser.add_argument('--connect', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=20)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSONL file, default is stdout')
+    args = parser.parse_args()
+    get_strategy(args.first)
+    get_strategy(args.second)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    pool = multiprocessing.Pool(args.processes)
+    records = []
+    start = time.time()
+    try:
+        work = batches(args.games, args.batch_size, args.size or [(6, 7)],
+                       args.connect, args.first, args.second, args.seed)
+        for batch in pool.imap_unordered(play_batch, work):
+            for record in batch:
+                output.write(json.dumps(record, sort_keys=True) + '\n')
+            output.flush()
+            records.extend(batch)
+        summary = summarize(records, time.time() - start)
+        output.write(json.dumps(summary, sort_keys=True) + '\n')
+    finally:
+        pool.close()
+        pool.join()
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,471 @@
+"""turns.py - Commit stage for make_move, make_moves and cancel_game.
+
+make_move commits the user move in one transaction rooted at the Game key
+and leaves the reply of the Computer to the worker pool (workers.py), which
+commits it in a second transaction. make_moves searches the replies of a
+batch on copies of its games first and then replays the moves with these
+replies in one short transaction, which only commits the games that did not
+change in the meantime. Every entity a turn creates is collected and written
+with one ndb.put_multi. When the game ends the UserStats of the player are
+part of the same (cross-group) transaction."""
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+import endpoints
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from models import UserStats
+
+# a cross-group transaction can touch 25 entity groups: the games and the
+# UserStats of their users
+MAX_BATCH_GAMES = 10
+# every move of a batch is answered by a search before the transaction, all
+# searches together get BATCH_AI_SECONDS
+MAX_BATCH_MOVES = 20
+BATCH_AI_SECONDS = 20.0
+
+MOVE_OK = 'OK'
+MOVE_INVALID = 'INVALID_MOVE'
+MOVE_NOT_FOUND = 'NOT_FOUND'
+MOVE_GAME_OVER = 'GAME_OVER'
+MOVE_CANCELED = 'CANCELED'
+MOVE_AI_PENDING = 'AI_PENDING'
+MOVE_CONFLICT = 'CONFLICT'
+
+AI_THINKING = 'The Computer is thinking...'
+# a reply still missing after this long is submitted again
+AI_STALE = timedelta(seconds=60)
+
+
+class MoveNotPlayed(Exception):
+    """The game does not take a move right now. status is one of
+    MOVE_GAME_OVER, MOVE_CANCELED and MOVE_AI_PENDING, the message is the
+    one for the user."""
+
+    def __init__(self, status, message):
+        super(MoveNotPlayed, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+def unique_entities(entities):
+    """Returns the entities without duplicates. Entities with a complete
+    key are the same if their keys are, others only if they are the same
+    object."""
+    result = []
+    keys = set()
+    for entity in entities:
+        key = entity.key
+        if key is not None and key.id() is not None:
+            if key in keys:
+                continue
+            keys.add(key)
+        elif any(entity is e for e in result):
+            continue
+        result.append(entity)
+    return result
+
+
+class Turn(object):
+    """Plays moves on a loaded game and collects the entities they create.
+    Turns in the same transaction share loaded_stats, the dict of the
+    UserStats they changed, so a user finishing several games is updated
+    on one entity."""
+
+    def __init__(self, game, loaded_stats=None):
+        self.game = game
+        self.loaded_stats = {} if loaded_stats is None else loaded_stats
+        self.entities = []
+        self.changed = False
+        self.ai_column = None
+
+    def add(self, entity):
+        self.entities.append(entity)
+
+    def extend(self, entities):
+        self.entities.extend(entities)
+
+    def log(self, column, row, result):
+        """Logs a played move in the history of the game"""
+        self.changed = True
+        entry = self.game.log_move(column, row, result)
+        if entry:
+            self.add(entry)
+
+    def to_put(self):
+        """Returns the game and all collected entities, each entity once"""
+        return unique_entities([self.game] + self.entities)
+
+    def commit_async(self):
+        """Writes the game and all collected entities in one batch"""
+        return ndb.put_multi_async(self.to_put())
+
+    def play(self, move_column, ai_user_key, time_limit=None,
+             ai_column=None):
+        """Plays the user move in move_column and the reply of the Computer
+        in memory. The reply is played in ai_column if it is given and
+        searched, within time_limit seconds if that is given, otherwise.
+        Its column is kept in ai_column. Returns the message for the user.
+
+        Raises:
+            MoveNotPlayed: If the game does not take a move.
+            endpoints.BadRequestException: If the move is not valid.
+        """
+        self.ai_column = None
+        message = self.play_user_move(move_column)
+        if message:
+            return message
+        if ai_column is None:
+            ai_column = self.game.get_ai_column(time_limit)
+        self.ai_column = ai_column
+        return self.play_ai_move(ai_user_key, ai_column)
+
+    def play_user_move(self, move_column):
+        """Plays the user move in move_column in memory. Returns the message
+        for the user, or None if it is the Computer's turn now.
+
+        Raises:
+            MoveNotPlayed: If the game does not take a move.
+            endpoints.BadRequestException: If the move is not valid.
+        """
+        game = self.game
+        if game.game_over:
+            raise MoveNotPlayed(MOVE_GAME_OVER, 'Game already over!')
+
+        if game.game_canceled:
+            raise MoveNotPlayed(MOVE_CANCELED, 'Game has been canceled!')
+
+        if game.ai_pending:
+            raise MoveNotPlayed(MOVE_AI_PENDING,
+                                'Wait for the Computer to move!')
+
+        if move_column < 0 or move_column >= game.columns:
+            raise endpoints.BadRequestException(
+                'Column must be within game Boundaries')
+
+        if not game.get_bitboard().can_play(move_column):
+            raise endpoints.BadRequestException('Column is filled')
+
+        # do user move
+        game.moves += 1
+        row = game.drop_disc(game.user, move_column)
+
+        if game.check_win(game.user, move_column, row):
+            self.extend(game.end_game(True, loaded_stats=self.loaded_stats))
+            self.log(move_column, row, "won")
+            return 'You win!'
+
+        if game.check_full():
+            self.extend(game.end_game(False, draw=True,
+                                      loaded_stats=self.loaded_stats))
+            self.log(move_column, row, "game ended with no winner")
+            return 'Game over! No one wins! Player was last!'
+
+        self.log(move_column, row, "player made move")
+        return None
+
+    def play_ai_move(self, ai_user_key, ai_column):
+        """Plays the reply of the Computer in ai_column in memory. Returns
+        the message for the user."""
+        game = self.game
+        game.ai_pending = False
+        ai_row = game.drop_disc(ai_user_key, ai_column)
+
+        if game.check_win(ai_user_key, ai_column, ai_row):
+            self.extend(game.end_game(False,
+                                      loaded_stats=self.loaded_stats))
+            self.log(ai_column, ai_row, "game lost")
+            return 'Game Over! You lost!'
+
+        if game.check_full():
+            self.extend(game.end_game(False, draw=True,
+                                      loaded_stats=self.loaded_stats))
+            self.log(ai_column, ai_row, "game ended with no winner")
+            return 'Game over! No one wins! Computer was last!'
+
+        self.log(ai_column, ai_row, "Computer made move")
+        return 'Nice try! Go on!'
+
+
+def play_user_move(game_key, move_column, pool):
+    """Plays the user move in move_column and hands the reply of the
+    Computer to the worker pool, which commits it later.
+
+    Args:
+        game_key: The ndb.Key of the Game.
+        move_column: The column the user drops a disc into.
+        pool: The workers.Pool computing the reply.
+    Returns:
+        A tuple of the updated Game and the message for the user.
+    Raises:
+        endpoints.NotFoundException: If the game does not exist.
+        endpoints.BadRequestException: If the move is not valid.
+        endpoints.ConflictException: If another request changed the game
+            while this move was played.
+    """
+    return play_user_move_async(game_key, move_column, pool).get_result()
+
+
+@ndb.tasklet
+def play_user_move_async(game_key, move_column, pool):
+    """Async version of play_user_move. A pool that enqueues tasks submits
+    the reply in the transaction of the move, other pools right after it
+    committed."""
+    try:
+        game, message = yield ndb.transaction_async(
+            lambda: _play_user_move(game_key, move_column, pool),
+            retries=0, xg=True)
+    except datastore_errors.TransactionFailedError:
+        raise endpoints.ConflictException(
+            'The game has been changed by another request, please retry!')
+    if game.ai_pending:
+        if message == AI_THINKING and not pool.transactional:
+            pool.submit(game)
+        elif message != AI_THINKING and \
+                game.ai_requested < datetime.now() - AI_STALE:
+            # the reply got lost, e.g. with the instance that computed it
+            logging.warning('Resubmitting the reply of game %s',
+                            game_key.urlsafe())
+            pool.submit(game)
+    raise ndb.Return(game, message)
+
+
+@ndb.tasklet
+def _play_user_move(game_key, move_column, pool):
+    game = yield game_key.get_async()
+    if not game:
+        raise endpoints.NotFoundException('Game not found!')
+
+    turn = Turn(game)
+    try:
+        message = turn.play_user_move(move_column)
+    except MoveNotPlayed as e:
+        raise ndb.Return(game, e.message)
+    if message is None:
+        game.ai_pending = True
+        game.ai_requested = datetime.now()
+        message = AI_THINKING
+    if turn.changed:
+        yield turn.commit_async()
+        if game.ai_pending and pool.transactional:
+            pool.submit(game)
+    raise ndb.Return(game, message)
+
+
+def play_ai_move(game_key, version, ai_column, ai_user_key):
+    """Commits the reply of the Computer computed for the given version of
+    the game. Returns the updated Game, or None if the game changed in the
+    meantime (e.g. the reply was already committed by a retried task).
+
+    Raises:
+        endpoints.ConflictException: If another request changed the game
+            at the same time.
+    """
+    return play_ai_move_async(game_key, version, ai_column,
+                              ai_user_key).get_result()
+
+
+@ndb.tasklet
+def play_ai_move_async(game_key, version, ai_column, ai_user_key):
+    """Async version of play_ai_move"""
+    try:
+        game = yield ndb.transaction_async(
+            lambda: _play_ai_move(game_key, version, ai_column, ai_user_key),
+            retries=0, xg=True)
+    except datastore_errors.TransactionFailedError:
+        raise endpoints.ConflictException(
+            'The game has been changed by another request, please retry!')
+    raise ndb.Return(game)
+
+
+@ndb.tasklet
+def _play_ai_move(game_key, version, ai_column, ai_user_key):
+    game = yield game_key.get_async()
+    if not game or not game.ai_pending or game.version != version:
+        raise ndb.Return(None)
+    turn = Turn(game)
+    turn.play_ai_move(ai_user_key, ai_column)
+    yield turn.commit_async()
+    raise ndb.Return(game)
+
+
+def play_moves(moves, ai_user_key):
+    """Plays several moves, in one or more games. Moves of the same game
+    are played in the given order. The replies of the Computer are searched
+    on copies of the games first, then all moves are replayed with these
+    replies in a single short transaction. Moves of a game that another
+    request changed in the meantime get the status MOVE_CONFLICT and are
+    not played.
+
+    Args:
+        moves: A list of (game key, move column) tuples.
+        ai_user_key: The key of the Computer User or a Future of it.
+    Returns:
+        A tuple of the list of (status, message) of every move and a dict
+        of game key -> Game (None for games that do not exist).
+    Raises:
+        endpoints.NotFoundException: If the AI user does not exist.
+        endpoints.BadRequestException: If the batch is too large.
+        endpoints.ConflictException: If another request changed one of the
+            games while the transaction ran.
+    """
+    return play_moves_async(moves, ai_user_key).get_result()
+
+
+def batch_game_keys(moves):
+    """Returns the keys of the games of a batch of (game key, move column)
+    moves, each once, in order.
+
+    Raises:
+        endpoints.BadRequestException: If the batch has too many moves or
+            touches too many games.
+    """
+    if len(moves) > MAX_BATCH_MOVES:
+        raise endpoints.BadRequestException(
+            'A batch can contain at most {} moves'.format(MAX_BATCH_MOVES))
+    game_keys = []
+    for game_key, _ in moves:
+        if game_key not in game_keys:
+            game_keys.append(game_key)
+    if len(game_keys) > MAX_BATCH_GAMES:
+        raise endpoints.BadRequestException(
+            'A batch can contain moves of at most {} games'.format(
+                MAX_BATCH_GAMES))
+    return game_keys
+
+
+@ndb.tasklet
+def play_moves_async(moves, ai_user_key):
+    """Async version of play_moves"""
+    game_keys = batch_game_keys(moves)
+
+    # copies for the searches, kept out of the context cache so the
+    # transaction loads the games again
+    copies = ndb.get_multi_async(game_keys, use_cache=False)
+    if isinstance(ai_user_key, ndb.Future):
+        ai_user_key = yield ai_user_key
+    copies = dict(zip(game_keys, (yield copies)))
+    if not ai_user_key:
+        raise endpoints.NotFoundException('No AI User!')
+    versions = dict((key, game.version) for key, game in copies.items()
+                    if game)
+    ai_columns = _search_replies(moves, copies, ai_user_key,
+                                 time.time() + BATCH_AI_SECONDS)
+
+    try:
+        result = yield ndb.transaction_async(
+            lambda: _play_moves(moves, game_keys, ai_user_key, versions,
+                                ai_columns),
+            retries=0, xg=True)
+    except datastore_errors.TransactionFailedError:
+        raise endpoints.ConflictException(
+            'A game has been changed by another request, please retry!')
+    raise ndb.Return(result)
+
+
+def _search_replies(moves, copies, ai_user_key, deadline):
+    """Plays the moves on the copies of the games and returns the column of
+    the reply of the Computer to every move, None where there is none. The
+    time left until deadline is shared by the moves still to play."""
+    # scratch stats, a game ending here must not read or change the real
+    # UserStats
+    loaded_stats = dict((game.user, UserStats(user=game.user, user_name=''))
+                        for game in copies.values() if game)
+    turns = {}
+    ai_columns = []
+    for index, (game_key, move_column) in enumerate(moves):
+        game = copies[game_key]
+        if not game:
+            ai_columns.append(None)
+            continue
+        turn = turns.setdefault(game_key, Turn(game, loaded_stats))
+        time_limit = (deadline - time.time()) / (len(moves) - index)
+        try:
+            turn.play(move_column, ai_user_key, time_limit)
+        except (MoveNotPlayed, endpoints.BadRequestException):
+            pass
+        ai_columns.append(turn.ai_column)
+    return ai_columns
+
+
+@ndb.tasklet
+def _play_moves(moves, game_keys, ai_user_key, versions, ai_columns):
+    games = dict(zip(game_keys, (yield ndb.get_multi_async(game_keys))))
+
+    loaded_stats = {}
+    turns = {}
+    results = []
+    for (game_key, move_column), ai_column in zip(moves, ai_columns):
+        game = games[game_key]
+        if not game:
+            results.append((MOVE_NOT_FOUND, 'Game not found!'))
+            continue
+        if game.version != versions.get(game_key):
+            results.append((MOVE_CONFLICT, 'The game has been changed by '
+                            'another request, please retry!'))
+            continue
+        turn = turns.setdefault(game_key, Turn(game, loaded_stats))
+        try:
+            # same version as the copy, so the reply was searched for
+            # exactly this position; a minimal search is only a fallback
+            results.append((MOVE_OK, turn.play(move_column, ai_user_key,
+                                               0, ai_column)))
+        except MoveNotPlayed as e:
+            results.append((e.status, e.message))
+        except endpoints.BadRequestException as e:
+            results.append((MOVE_INVALID, str(e)))
+
+    entities = []
+    for turn in turns.values():
+        if turn.changed:
+            entities.extend(turn.to_put())
+    entities = unique_entities(entities)
+    if entities:
+        yield ndb.put_multi_async(entities)
+    raise ndb.Return(results, games)
+
+
+def cancel_game(game_key):
+    """Cancels the game and updates the open games of the user.
+
+    Args:
+        game_key: The ndb.Key of the Game.
+    Returns:
+        The canceled Game.
+    Raises:
+        endpoints.NotFoundException: If the game does not exist.
+        endpoints.BadRequestException: If the game is over or canceled.
+        endpoints.ConflictException: If another request changed the game
+            at the same time.
+    """
+    return cancel_game_async(game_key).get_result()
+
+
+@ndb.tasklet
+def cancel_game_async(game_key):
+    """Async version of cancel_game"""
+    try:
+        game = yield ndb.transaction_async(lambda: _cancel_game(game_key),
+                                           retries=0, xg=True)
+    except datastore_errors.TransactionFailedError:
+        raise endpoints.ConflictException(
+            'The game has been changed by another request, please retry!')
+    raise ndb.Return(game)
+
+
+@ndb.tasklet
+def _cancel_game(game_key):
+    game = yield game_key.get_async()
+    if not game:
+        raise endpoints.NotFoundException('Game not found!')
+    if game.game_over:
+        raise endpoints.BadRequestException('Game already over!')
+    if game.game_canceled:
+        raise endpoints.BadRequestException('Game already canceled!')
+
+    stats = game.cancel()
+    yield ndb.put_multi_async([game, stats])
+    raise ndb.Return(game)
@@ -1,9 +1,15 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import os
+import threading
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -17,8 +23,41 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
+    """Async version of get_by_urlsafe, returns a Future of the entity"""
+    key = _key_from_urlsafe(urlsafe)
+
+    entity = yield key.get_async()
+    if not entity:
+        raise ndb.Return(None)
+    if not isinstance(entity, model):
+        raise ValueError('Incorrect Kind')
+    raise ndb.Return(entity)
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key the urlsafe key string points to without fetching
+        the entity. Checks that the key is of the kind of the given model.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The ndb.Key of the entity.
+    Raises:
+        ValueError:"""
+    key = _key_from_urlsafe(urlsafe)
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+
+def _key_from_urlsafe(urlsafe):
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -27,9 +66,69 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+
+def get_page_args(request):
+    """Returns the page size and start Cursor of a paged list request.
+    Raises a BadRequestException if the cursor string is malformed."""
+    limit = min(request.limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    if limit < 1:
+        raise endpoints.BadRequestException('Limit must be positive')
+    if not request.cursor:
+        return limit, None
+    try:
+        return limit, Cursor(urlsafe=request.cursor)
+    except Exception:
+        raise endpoints.BadRequestException('Invalid Cursor')
+
+
+def get_offset_args(request):
+    """Returns the page size and start offset of a paged list request whose
+    cursor is a position in a list instead of a datastore Cursor. Raises a
+    BadRequestException if the cursor string is malformed."""
+    limit = min(request.limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    if limit < 1:
+        raise endpoints.BadRequestException('Limit must be positive')
+    if not request.cursor:
+        return limit, 0
+    try:
+        offset = int(request.cursor)
+    except ValueError:
+        raise endpoints.BadRequestException('Invalid Cursor')
+    if offset < 0:
+        raise endpoints.BadRequestException('Invalid Cursor')
+    return limit, offset
+
+
+def next_cursor(cursor, more):
+    """Returns the urlsafe string of the cursor of the next page or None"""
+    return cursor.urlsafe() if more and cursor else None
+
+
+def is_deployed():
+    """Returns True on App Engine, False on the development server and in
+    tests"""
+    return os.environ.get('SERVER_SOFTWARE', '').startswith(
+        'Google App Engine')
+
+
+class Backend(object):
+    """Process-wide instance of a pluggable service, created on first use:
+    by the deployed factory on App Engine and by the local one otherwise.
+    set() replaces the instance, e.g. in tests."""
+
+    def __init__(self, deployed, local):
+        self._deployed = deployed
+        self._local = local
+        self._lock = threading.Lock()
+        self._instance = None
+
+    def get(self):
+        with self._lock:
+            if self._instance is None:
+                factory = self._deployed if is_deployed() else self._local
+                self._instance = factory()
+            return self._instance
+
+    def set(self, instance):
+        with self._lock:
+            self._instance = instance
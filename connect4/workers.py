@@ -0,0 +1,223 @@
+"""workers.py - Worker pool computing the replies of the Computer.
+
+make_move only commits the user move and submits the game to the pool, so
+the search does not hold a frontend request thread. A job computes the reply
+for the submitted version of the game within AI_MOVE_DEADLINE seconds of the
+user move (the search returns the best move of its deepest finished
+iteration when the time is up), commits it with turns.play_ai_move, stores
+the new GameForm and notifies pollers. Clients pick the reply up with
+get_game or poll_game.
+
+TaskQueuePool pushes a task on the ai queue, in the transaction of the user
+move, and is used when deployed. ThreadPool runs the jobs on a bounded number
+of threads of the process, for the development server and local tests; when
+its queue is full the job runs in the submitting thread."""
+
+import logging
+import threading
+import time
+from Queue import Full, Queue
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import instrumentation
+from formcache import set_game_forms_async
+from models import User
+from notify import publish_game
+from turns import play_ai_move
+from utils import Backend
+
+AI_QUEUE = 'ai'
+AI_MOVE_DEADLINE = 10.0
+
+
+class PoolStats(object):
+    """Thread-safe job counters and compute/wait times of a pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.stale = 0
+        self.failed = 0
+        self.inline = 0
+        self.compute_seconds = 0.0
+        self.max_compute_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def job_done(self, wait, compute, stale):
+        with self._lock:
+            if stale:
+                self.stale += 1
+            else:
+                self.completed += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.compute_seconds += compute
+            self.max_compute_seconds = max(self.max_compute_seconds, compute)
+
+    def stats(self):
+        with self._lock:
+            jobs = self.completed + self.stale
+            return {
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'stale': self.stale,
+                'failed': self.failed,
+                'inline': self.inline,
+                'mean_compute_seconds':
+                    self.compute_seconds / jobs if jobs else None,
+                'max_compute_seconds': self.max_compute_seconds,
+                'mean_wait_seconds':
+                    self.wait_seconds / jobs if jobs else None,
+                'max_wait_seconds': self.max_wait_seconds,
+            }
+
+
+pool_stats = PoolStats()
+
+
+def run_job(game_key, version, requested):
+    """Computes and commits the reply of the Computer for the given version
+    of the game. requested is the time of the user move (seconds since the
+    epoch), the deadline of the reply counts from it."""
+    start = time.time()
+    wait = max(0.0, start - requested)
+    instrumentation.add_timing('ai.queue_wait', wait)
+    ai_user_key = User.get_ai_key_async()
+    game = game_key.get()
+    stale = not game or not game.ai_pending or game.version != version
+    if not stale:
+        time_limit = requested + AI_MOVE_DEADLINE - start
+        column = game.get_ai_column(time_limit)
+        game = play_ai_move(game_key, version, column,
+                            ai_user_key.get_result())
+        stale = game is None
+        if game:
+            form = game.to_form('')
+            set_game_forms_async([form]).get_result()
+            publish_game(game)
+    compute = time.time() - start
+    instrumentation.add_timing('ai.compute', compute)
+    pool_stats.job_done(wait, compute, stale)
+    if stale:
+        logging.info('Dropped outdated reply job of game %s version %d',
+                     game_key.urlsafe(), version)
+
+
+class Pool(object):
+    """Runs the reply jobs of games. transactional tells whether submit
+    has to be called in the transaction of the user move."""
+    transactional = False
+
+    def submit(self, game):
+        """Submits the reply of the Computer for the current version of the
+        game, which must already be put"""
+        raise NotImplementedError()
+
+    def queue_depth(self):
+        """Returns the number of jobs waiting to run"""
+        raise NotImplementedError()
+
+    def stats(self):
+        stats = pool_stats.stats()
+        stats['pool'] = self.__class__.__name__
+        stats['queue_depth'] = self.queue_depth()
+        return stats
+
+
+def _job_args(game):
+    return (game.key, game.version,
+            time.mktime(game.ai_requested.timetuple()) +
+            game.ai_requested.microsecond / 1e6)
+
+
+class ThreadPool(Pool):
+    """Runs the jobs on worker threads of this process. With zero workers
+    every job runs in the submitting thread."""
+
+    def __init__(self, workers=4, max_queued=100):
+        self.workers = workers
+        self._queue = Queue(max_queued)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='ai-worker')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            args = self._queue.get()
+            try:
+                run_job(*args)
+            except Exception:
+                pool_stats.add('failed')
+                logging.exception('Reply job failed')
+            finally:
+                ndb.get_context().clear_cache()
+                self._queue.task_done()
+
+    def submit(self, game):
+        pool_stats.add('submitted')
+        args = _job_args(game)
+        if self.workers:
+            self._start()
+            try:
+                self._queue.put_nowait(args)
+                return
+            except Full:
+                pass
+        pool_stats.add('inline')
+        run_job(*args)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def join(self):
+        """Waits until all submitted jobs are done"""
+        self._queue.join()
+
+
+class TaskQueuePool(Pool):
+    """Pushes every job as task on the ai queue, handled by AiMove in
+    main.py. Submitted in the transaction of the user move, so the task
+    exists exactly if the move was committed."""
+    transactional = True
+
+    def submit(self, game):
+        pool_stats.add('submitted')
+        key, version, requested = _job_args(game)
+        taskqueue.add(url='/tasks/ai_move',
+                      params={'game': key.urlsafe(), 'version': version,
+                              'requested': repr(requested)},
+                      queue_name=AI_QUEUE,
+                      transactional=ndb.in_transaction())
+
+    def queue_depth(self):
+        return taskqueue.QueueStatistics.fetch(AI_QUEUE).tasks
+
+
+_pool = Backend(TaskQueuePool, ThreadPool)
+
+
+def get_pool():
+    """Returns the pool in use, the task queue when deployed and threads
+    otherwise"""
+    return _pool.get()
+
+
+def set_pool(pool):
+    """Replaces the pool, e.g. with ThreadPool(workers=0) in tests"""
+    _pool.set(pool)